@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from ann import enable_ann, disable_ann
+from index import VectorIndex
+from store import EmbeddingStore
+
+CHUNK = 10000
+
+# recall@k and query throughput of the IVF index against exact cosine search. vectors are
+# drawn around random topic centers, like embeddings of related turns, and queries are
+# noisy copies of stored vectors
+def run(args):
+    results = {
+        'config': vars(args),
+        'sizes': { }
+    }
+    for size in args.sizes:
+        folder = tempfile.mkdtemp(prefix='andy_ann_')
+        try:
+            print('Benchmarking ANN on %d vectors...' % size)
+            rng = np.random.default_rng(0)
+            _write_vectors(folder, size, args.dim, args.topics, args.spread, rng)
+            queries = _queries(folder, args.queries, rng)
+
+            disable_ann()
+            exact = VectorIndex(folder)
+            start = time()
+            truth = [[m['id'] for _, m in exact.search(q, args.k)] for q in queries]
+            exact_seconds = time() - start
+
+            enable_ann(nprobe=args.nprobe[0], nlist=args.nlist, min_rows=0, iterations=args.iterations)
+            if os.path.exists(folder + '/ivf.npz'):
+                os.remove(folder + '/ivf.npz')
+            start = time()
+            approx = VectorIndex(folder)
+            build_seconds = time() - start
+            r = {
+                'exact_queries_per_second': len(queries) / exact_seconds,
+                'nlist': approx.ivf.nlist,
+                'build_seconds': build_seconds,
+                'nprobe': { }
+            }
+            for nprobe in args.nprobe:
+                approx.ivf.nprobe = nprobe
+                start = time()
+                found = [[m['id'] for _, m in approx.search(q, args.k)] for q in queries]
+                elapsed = time() - start
+                recall = np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+                r['nprobe'][str(nprobe)] = {
+                    'recall_at_k': float(recall),
+                    'queries_per_second': len(queries) / elapsed,
+                    'speedup': exact_seconds / elapsed
+                }
+                print('  nprobe %4d  recall@%d %.3f  %8.1f q/s' % (nprobe, args.k, recall, len(queries) / elapsed))
+            results['sizes'][str(size)] = r
+        finally:
+            disable_ann()
+            shutil.rmtree(folder)
+    return results
+
+def _write_vectors(folder, n, dim, topics, spread, rng):
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    store = EmbeddingStore(folder)
+    for start in range(0, n, CHUNK):
+        count = min(CHUNK, n - start)
+        vectors = centers[rng.integers(0, topics, count)] + rng.standard_normal((count, dim)).astype(np.float32) * spread
+        store.append([{ 'embedding': v } for v in vectors])
+
+def _queries(folder, n, rng):
+    vectors = EmbeddingStore(folder).vectors()
+    rows = rng.integers(0, len(vectors), n)
+    return np.asarray(vectors[rows]) + rng.standard_normal((n, vectors.shape[1])).astype(np.float32) * 0.3
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recall@k and throughput of the IVF index against exact search')
+    parser.add_argument('--sizes', type=lambda s: [int(x) for x in s.split(',')], default=[100000])
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--topics', type=int, default=1000, help='number of clusters the synthetic vectors are drawn around')
+    parser.add_argument('--spread', type=float, default=1.5, help='noise around the cluster centers, higher is harder')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=None, help='lists in the index, sqrt(size) by default')
+    parser.add_argument('--nprobe', type=lambda s: [int(x) for x in s.split(',')], default=[1, 4, 16, 64])
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--out', default='bench_ann.json')
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.out, 'w', encoding='utf-8') as outfile:
+        json.dump(results, outfile, indent=2)
+    print(json.dumps(results, indent=2))
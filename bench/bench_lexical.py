@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from time import perf_counter, time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from index import VectorIndex
+from lexical import configure_retrieval, tokenize
+from store import EmbeddingStore
+
+CHUNK = 10000
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'te', 'vo', 'zu', 'shi', 'ne', 'pa', 'dor', 'el', 'quin', 'by', 'gar']
+FILLER = 'The user talked about'
+SHAPES = ['message', 'chat']
+
+# latency and hit@k of each retrieval mode on queries that name an entity of one stored
+# memory. memories mix topic words with a unique entity name and are embedded as a bag of
+# random word vectors, so vector search sees the entity diluted by the rest of the text.
+# the message shape sends the question alone, the chat shape builds queries the way
+# Andy._memory_query does: the question is embedded after the previous system prompt, which
+# lists memories retrieved last turn, and only the question is searched in the BM25 index
+def run(args):
+    results = {
+        'config': vars(args),
+        'sizes': { }
+    }
+    for size in args.sizes:
+        folder = tempfile.mkdtemp(prefix='andy_lexical_')
+        try:
+            print('Benchmarking retrieval on %d memories...' % size)
+            rng = np.random.default_rng(0)
+            model = WordModel(args.dim, rng)
+            queries = _write_memories(folder, size, args.topics, args.queries, model, rng)
+            shapes = {
+                'message': [(text, text, target) for text, target in queries],
+                'chat': _chat_queries(folder, queries, args.context_memories, rng)
+            }
+            configure_retrieval('vector')
+            index = VectorIndex(folder)
+            start = time()
+            index._lexical()
+            r = {
+                'bm25_build_seconds': time() - start,
+                'shapes': { }
+            }
+            for shape in SHAPES:
+                r['shapes'][shape] = { }
+                for mode in ['vector', 'lexical', 'rerank', 'fusion']:
+                    configure_retrieval(mode, candidates=args.candidates, weight=args.weight)
+                    hits = 0
+                    embedded = 0
+                    times = []
+                    for query, text, target in shapes[shape]:
+                        start = perf_counter()
+                        found = index.lexical_search(text, args.k) if mode == 'lexical' else []
+                        if len(found) == 0:
+                            # vector, rerank, fusion and lexical misses need the query embedding first
+                            found = index.search(model.embed(query), args.k, text=text)
+                            embedded += 1
+                        times.append(perf_counter() - start)
+                        hits += target in [m['id'] for _, m in found]
+                    search_ms = float(np.mean(times) * 1000)
+                    r['shapes'][shape][mode] = {
+                        'hit_at_k': hits / len(queries),
+                        'search_ms': search_ms,
+                        'p99_search_ms': float(np.percentile(times, 99) * 1000),
+                        'embedded_queries': embedded,
+                        # the embedding round trip each mode pays per query on average
+                        'round_trip_ms': search_ms + args.embedding_latency * embedded / len(queries)
+                    }
+                    print('  %-7s %-8s hit@%d %.3f  search %7.3f ms  with embedding %7.1f ms' % (
+                        shape, mode, args.k, hits / len(queries), search_ms, r['shapes'][shape][mode]['round_trip_ms']))
+            results['sizes'][str(size)] = r
+            index.close()
+        finally:
+            configure_retrieval('vector')
+            shutil.rmtree(folder)
+    return results
+
+# embeds text as the normalized sum of a random vector per word
+class WordModel:
+    def __init__(self, dim, rng):
+        self.dim = dim
+        self.rng = rng
+        self._words = { }
+
+    def embed(self, text):
+        v = np.zeros(self.dim, dtype=np.float32)
+        for word in tokenize(text):
+            if word not in self._words:
+                self._words[word] = self.rng.standard_normal(self.dim).astype(np.float32)
+            v += self._words[word]
+        return v / (np.linalg.norm(v) or 1)
+
+# (embedded query, BM25 query, target) triples shaped like Andy._memory_query, with the
+# previous system prompt listing other memories that were retrieved last turn
+def _chat_queries(folder, queries, context_memories, rng):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prompts', 'prompt_system_default.txt'), 'r', encoding='utf-8') as infile:
+        system = infile.read()
+    meta = [m for m in EmbeddingStore(folder).read_log()[1].values()]
+    shaped = []
+    for text, target in queries:
+        shown = rng.choice(len(meta), context_memories, replace=False)
+        memories = ''.join('\n- ' + meta[i]['salient_points'] for i in shown)
+        prompt = system + '\nBEGIN_MEMORIES:' + memories + '\nEND_MEMORIES'
+        shaped.append((prompt + '\nUSER:' + text, text, target))
+    return shaped
+
+def _word(rng, syllables):
+    return ''.join(rng.choice(SYLLABLES, syllables))
+
+# returns (query, id of the memory it names) pairs
+def _write_memories(folder, n, topics, n_queries, model, rng):
+    vocab = [[_word(rng, 2) for _ in range(20)] for _ in range(topics)]
+    store = EmbeddingStore(folder)
+    queries = []
+    for start in range(0, n, CHUNK):
+        objs = []
+        for i in range(start, min(n, start + CHUNK)):
+            topic = vocab[rng.integers(topics)]
+            entity = '%s%d' % (_word(rng, 3).capitalize(), i)
+            words = list(rng.choice(topic, 8))
+            text = '%s %s and %s' % (FILLER, ' '.join(words), entity)
+            objs.append({ 'salient_points': text, 'embedding': model.embed(text) })
+            if len(queries) < n_queries and rng.random() < n_queries / n * 2:
+                queries.append(('What do I remember about %s %s' % (entity, ' '.join(rng.choice(words, 2))), i))
+        store.append(objs)
+    return queries
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency and hit@k of lexical, rerank and fusion retrieval against vector-only search')
+    parser.add_argument('--sizes', type=lambda s: [int(x) for x in s.split(',')], default=[10000, 100000])
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--topics', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--candidates', type=int, default=200)
+    parser.add_argument('--weight', type=float, default=0.3)
+    parser.add_argument('--context-memories', type=int, default=8, help='memories listed in the previous system prompt of chat shaped queries')
+    parser.add_argument('--embedding-latency', type=float, default=150, help='milliseconds added for each query that has to be embedded')
+    parser.add_argument('--out', default='bench_lexical.json')
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.out, 'w', encoding='utf-8') as outfile:
+        json.dump(results, outfile, indent=2)
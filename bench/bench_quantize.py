@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from index import VectorIndex
+from quantize import enable_quantization, disable_quantization
+from store import EmbeddingStore
+
+CHUNK = 10000
+
+# memory footprint, scan throughput and recall@k of each quantization mode against exact
+# cosine search, with and without the exact re-rank. vectors are drawn around random topic
+# centers and queries are noisy copies of stored vectors
+def run(args):
+    results = {
+        'config': vars(args),
+        'sizes': { }
+    }
+    for size in args.sizes:
+        folder = tempfile.mkdtemp(prefix='andy_quantize_')
+        try:
+            print('Benchmarking quantization on %d vectors...' % size)
+            rng = np.random.default_rng(0)
+            _write_vectors(folder, size, args.dim, args.topics, args.spread, rng)
+            queries = _queries(folder, args.queries, rng)
+
+            disable_quantization()
+            exact = VectorIndex(folder)
+            start = time()
+            truth = [[m['id'] for _, m in exact.search(q, args.k)] for q in queries]
+            exact_seconds = time() - start
+            r = {
+                'exact': {
+                    'bytes': exact._vectors.nbytes,
+                    'rows_per_second': size * len(queries) / exact_seconds
+                }
+            }
+            print('  %-16s %10.1f MB  %12.0f rows/s' % ('float32', exact._vectors.nbytes / 1e6, r['exact']['rows_per_second']))
+            for mode in args.modes:
+                for rerank in [0, args.rerank]:
+                    if os.path.exists(folder + '/codes.npz'):
+                        os.remove(folder + '/codes.npz')
+                    enable_quantization(mode, rerank=rerank, iterations=args.iterations)
+                    start = time()
+                    index = VectorIndex(folder)
+                    build_seconds = time() - start
+                    start = time()
+                    found = [[m['id'] for _, m in index.search(q, args.k)] for q in queries]
+                    elapsed = time() - start
+                    recall = np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+                    name = mode if rerank == 0 else '%s+rerank%d' % (mode, rerank)
+                    r[name] = {
+                        'bytes': index.codes.nbytes(),
+                        'compression': exact._vectors.nbytes / index.codes.nbytes(),
+                        'build_seconds': build_seconds,
+                        'rows_per_second': size * len(queries) / elapsed,
+                        'recall_at_k': float(recall)
+                    }
+                    print('  %-16s %10.1f MB  %12.0f rows/s  recall@%d %.3f' % (
+                        name, index.codes.nbytes() / 1e6, r[name]['rows_per_second'], args.k, recall))
+            results['sizes'][str(size)] = r
+        finally:
+            disable_quantization()
+            shutil.rmtree(folder)
+    return results
+
+def _write_vectors(folder, n, dim, topics, spread, rng):
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    store = EmbeddingStore(folder)
+    for start in range(0, n, CHUNK):
+        count = min(CHUNK, n - start)
+        vectors = centers[rng.integers(0, topics, count)] + rng.standard_normal((count, dim)).astype(np.float32) * spread
+        store.append([{ 'embedding': v } for v in vectors])
+
+def _queries(folder, n, rng):
+    vectors = EmbeddingStore(folder).vectors()
+    rows = rng.integers(0, len(vectors), n)
+    return np.asarray(vectors[rows]) + rng.standard_normal((n, vectors.shape[1])).astype(np.float32) * 0.3
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Footprint, scan throughput and recall@k of quantized vectors against exact search')
+    parser.add_argument('--sizes', type=lambda s: [int(x) for x in s.split(',')], default=[100000])
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--topics', type=int, default=1000)
+    parser.add_argument('--spread', type=float, default=1.5)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--modes', type=lambda s: s.split(','), default=['float16', 'int8', 'pq'])
+    parser.add_argument('--rerank', type=int, default=100, help='candidates re-scored on the float32 rows')
+    parser.add_argument('--iterations', type=int, default=10, help='k-means iterations of the product quantizer')
+    parser.add_argument('--out', default='bench_quantize.json')
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.out, 'w', encoding='utf-8') as outfile:
+        json.dump(results, outfile, indent=2)
@@ -0,0 +1,41 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from store import EmbeddingStore
+
+CHUNK = 10000
+
+# writes synthetic memories and concepts into root/embeddings and root/concepts.
+# duplicate_rate of the rows are near copies of earlier rows so deduplication has work to do
+def generate_corpus(root, n_memories, n_concepts, dim=1536, duplicate_rate=0.01, seed=0):
+    rng = np.random.default_rng(seed)
+    for folder, n, make_meta in [
+        ('embeddings', n_memories, _memory_meta),
+        ('concepts', n_concepts, _concept_meta)
+    ]:
+        store = EmbeddingStore(os.path.join(root, folder))
+        for start in range(0, n, CHUNK):
+            count = min(CHUNK, n - start)
+            vectors = rng.standard_normal((count, dim)).astype(np.float32)
+            dups = np.flatnonzero(rng.random(count) < duplicate_rate)
+            dups = dups[dups > 0]
+            vectors[dups] = vectors[dups - 1] + rng.standard_normal((len(dups), dim)).astype(np.float32) * 0.01
+            vectors /= np.linalg.norm(vectors, axis=1)[:, None]
+            objs = [make_meta(start + i) for i in range(count)]
+            for o, v in zip(objs, vectors):
+                o['embedding'] = v
+            store.append(objs)
+
+def _memory_meta(i):
+    return {
+        'time': str(1680000000 + i),
+        'anticipation': 'The user wants to continue topic %d' % (i % 97),
+        'salient_points': 'The user talked about topic %d and detail %d' % (i % 97, i),
+        'message': 'message %d' % i,
+        'response': 'response %d' % i
+    }
+
+def _concept_meta(i):
+    return { 'data': 'Concept %d about topic %d' % (i, i % 97) }
@@ -0,0 +1,120 @@
+import argparse
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+import numpy as np
+
+# canned completion, the lines double as concept keys and concept add/update instructions
+COMPLETION_TEXT = 'Add the user is running a benchmark\nUpdate the assistant answers quickly\nbenchmark latency'
+CHAT_TEXT = 'This is a reply from the mock server.'
+
+# local stand-in for /v1/completions, /v1/chat/completions and /v1/embeddings
+# with a fixed latency per request and deterministic embeddings. streamed chat
+# replies wait token_latency before each chunk
+class MockOpenAI:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, embedding_latency=None, dim=1536, token_latency=0.0):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.embedding_latency = latency if embedding_latency is None else embedding_latency
+        self.dim = dim
+        self.requests = { }
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d/v1' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def embedding(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        v = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return (v / np.linalg.norm(v)).tolist()
+
+    def handle(self, path, req):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+        if path == '/v1/embeddings':
+            sleep(self.embedding_latency)
+            inputs = req['input'] if isinstance(req['input'], list) else [req['input']]
+            tokens = sum(len(i.split()) for i in inputs)
+            return {
+                'data': [{ 'index': i, 'embedding': self.embedding(t) } for i, t in enumerate(inputs)],
+                'usage': { 'prompt_tokens': tokens, 'total_tokens': tokens }
+            }
+        sleep(self.latency)
+        if path == '/v1/completions':
+            prompt_tokens = len(req['prompt'].split())
+            completion_tokens = len(COMPLETION_TEXT.split())
+            return {
+                'choices': [{ 'text': COMPLETION_TEXT }],
+                'usage': { 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens }
+            }
+        if path == '/v1/chat/completions':
+            prompt_tokens = sum(len(m['content'].split()) for m in req['messages'])
+            completion_tokens = len(CHAT_TEXT.split())
+            return {
+                'choices': [{ 'message': { 'role': 'assistant', 'content': CHAT_TEXT } }],
+                'usage': { 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens }
+            }
+        return None
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        res = self.server.mock.handle(self.path, req)
+        if res is not None and req.get('stream'):
+            self._stream(res['choices'][0]['message'])
+        elif res is None:
+            self._send(404, { 'error': { 'message': 'unknown path ' + self.path } })
+        else:
+            self._send(200, res)
+
+    # server-sent events, one chunk per word, ended by [DONE]
+    def _stream(self, message):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        words = message['content'].split(' ')
+        chunks = [{ 'role': message['role'] }] + [{ 'content': w if i == 0 else ' ' + w } for i, w in enumerate(words)]
+        for delta in chunks:
+            sleep(self.server.mock.token_latency)
+            self.wfile.write(('data: %s\n\n' % json.dumps({ 'choices': [{ 'delta': delta }] })).encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the OpenAI api')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--embedding-latency', type=float, default=None)
+    parser.add_argument('--dim', type=int, default=1536)
+    args = parser.parse_args()
+    mock = MockOpenAI(port=args.port, latency=args.latency, embedding_latency=args.embedding_latency, dim=args.dim)
+    print('Serving mock api at %s, set OPENAI_API_BASE to use it' % mock.base_url)
+    mock._server.serve_forever()
@@ -0,0 +1,183 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# src goes first so bench scripts never shadow the modules they measure
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from corpus import generate_corpus
+from mock_server import MockOpenAI
+
+# runs every benchmark in a scratch directory holding a copy of prompts/ and a synthetic corpus
+def run(args):
+    from cache import configure_embedding_cache
+    from index import get_index, clear_indexes
+    from transport import configure_transport, configure_async_transport
+    from util import get_closest_embeddings, clean_embedding_folder
+
+    mock = MockOpenAI(latency=args.latency, embedding_latency=args.embedding_latency, dim=args.dim, token_latency=args.token_latency)
+    base_url = mock.start()
+    configure_transport(base_url=base_url)
+    configure_async_transport(base_url=base_url)
+    results = {
+        'commit': _commit(),
+        'time': time(),
+        'config': vars(args),
+        'sizes': { }
+    }
+    cwd = os.getcwd()
+    try:
+        for size in args.sizes:
+            workdir = tempfile.mkdtemp(prefix='andy_bench_')
+            shutil.copytree(os.path.join(ROOT, 'prompts'), os.path.join(workdir, 'prompts'))
+            os.chdir(workdir)
+            clear_indexes()
+            configure_embedding_cache()
+            r = { }
+            print('Benchmarking %d memories...' % size)
+
+            start = time()
+            generate_corpus(workdir, size, max(1, size // 10), args.dim)
+            r['generate_seconds'] = time() - start
+
+            start = time()
+            get_index('embeddings')
+            get_index('concepts')
+            r['index_load_seconds'] = time() - start
+
+            rng = np.random.default_rng(1)
+            queries = rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+            start = time()
+            for q in queries:
+                get_closest_embeddings('embeddings', q, 3)
+            elapsed = time() - start
+            r['retrieval'] = {
+                'queries': args.queries,
+                'seconds': elapsed,
+                'queries_per_second': args.queries / elapsed,
+                'vectors_per_second': args.queries * size / elapsed
+            }
+
+            index = get_index('embeddings')
+            new_ids = index.add([
+                { 'salient_points': 'new %d' % i, 'embedding': v }
+                for i, v in enumerate(rng.standard_normal((10, args.dim)).astype(np.float32))
+            ])
+            start = time()
+            clean_embedding_folder('embeddings', 0.99, new_ids)
+            r['clean_incremental_seconds'] = time() - start
+            if size <= args.clean_max:
+                start = time()
+                clean_embedding_folder('embeddings', 0.99)
+                r['clean_full_seconds'] = time() - start
+
+            r.update(_bench_andy(args))
+            if args.sessions > 0:
+                r['async_sessions'] = asyncio.run(_bench_sessions(args))
+            results['sizes'][str(size)] = r
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+    finally:
+        os.chdir(cwd)
+        mock.stop()
+    results['mock_requests'] = mock.requests
+    return results
+
+def _bench_andy(args):
+    from andy import Andy
+    from usage import get_usage_ledger
+
+    ledger = get_usage_ledger()
+    start = time()
+    andy = Andy('bench', 'bench')
+    startup = time() - start
+    turns = []
+    first_tokens = []
+    ledger.reset()
+    for i in range(args.turns):
+        start = time()
+        on_token = None
+        if args.stream:
+            def on_token(token):
+                if len(first_tokens) == i:
+                    first_tokens.append(time() - start)
+        andy.send_chat('Benchmark message number %d, tell me something new.' % i, on_token=on_token)
+        turns.append(time() - start)
+    stages = ledger.summary()
+    for c in stages.values():
+        c['latency_per_turn'] = c['latency'] / args.turns
+
+    start = time()
+    andy.save_messages()
+    save_seconds = time() - start
+    andy.close()
+    return {
+        'andy_startup_seconds': startup,
+        'send_chat': {
+            'turns': args.turns,
+            'mean_seconds': sum(turns) / len(turns),
+            'max_seconds': max(turns),
+            'mean_first_token_seconds': sum(first_tokens) / len(first_tokens) if len(first_tokens) > 0 else None,
+            'stages': stages
+        },
+        'save_messages_seconds': save_seconds
+    }
+
+# args.sessions conversations sharing one event loop, each sending args.turns messages
+async def _bench_sessions(args):
+    from andy import Andy
+    from transport import get_async_transport
+
+    sessions = [Andy('bench', 'bench') for _ in range(args.sessions)]
+    async def converse(andy, n):
+        for i in range(args.turns):
+            await andy.asend_chat('Session %d message number %d, tell me something new.' % (n, i))
+
+    start = time()
+    await asyncio.gather(*[converse(andy, n) for n, andy in enumerate(sessions)])
+    elapsed = time() - start
+    await get_async_transport().close()
+    for andy in sessions:
+        andy.close()
+    return {
+        'sessions': args.sessions,
+        'turns': args.sessions * args.turns,
+        'seconds': elapsed,
+        'turns_per_second': args.sessions * args.turns / elapsed
+    }
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark retrieval, cleaning and the chat pipeline against a mock api')
+    parser.add_argument('--sizes', type=lambda s: [int(x) for x in s.split(',')], default=[1000, 10000, 100000],
+        help='comma separated corpus sizes, e.g. 1000,10000,100000,1000000')
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--turns', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.05, help='mock completion latency in seconds')
+    parser.add_argument('--embedding-latency', type=float, default=0.02, help='mock embedding latency in seconds')
+    parser.add_argument('--token-latency', type=float, default=0.0, help='mock delay before each streamed chat chunk')
+    parser.add_argument('--stream', action='store_true', help='stream chat replies and report time to first token')
+    parser.add_argument('--sessions', type=int, default=0, help='also run this many concurrent asyncio sessions')
+    parser.add_argument('--clean-max', type=int, default=10000, help='largest corpus to run a full clean on')
+    parser.add_argument('--out', default='bench_results.json')
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.out, 'w', encoding='utf-8') as outfile:
+        json.dump(results, outfile, indent=2)
+    print(json.dumps(results, indent=2))
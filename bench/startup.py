@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+HEAVY_MODULES = ['numpy', 'tiktoken', 'requests', 'aiohttp', 'openai', 'pandas', 'scipy', 'sklearn', 'plotly']
+
+# runs in a fresh interpreter so every import is cold, prints its timings as json
+CHILD = '''
+import json, sys
+from time import perf_counter
+start = perf_counter()
+sys.path.insert(0, %r)
+from andy import Andy
+imported = perf_counter()
+andy = Andy('key', 'org', root='session')
+constructed = perf_counter()
+print(json.dumps({
+    'import_seconds': imported - start,
+    'construct_seconds': constructed - imported,
+    'modules': [m for m in %r if m in sys.modules]
+}))
+'''
+
+# import time of andy, construction time of Andy and the wall time until main.py would show its
+# first prompt, each the median of fresh processes. also lists which heavy modules startup loaded
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='andy_startup_')
+    shutil.copytree(os.path.join(ROOT, 'prompts'), os.path.join(workdir, 'prompts'))
+    code = CHILD % (os.path.join(os.path.abspath(ROOT), 'src'), HEAVY_MODULES)
+    runs = []
+    try:
+        for i in range(args.runs):
+            shutil.rmtree(os.path.join(workdir, 'session'), ignore_errors=True)
+            start = time()
+            out = subprocess.run([sys.executable, '-c', code], cwd=workdir, capture_output=True, text=True, check=True).stdout
+            r = json.loads(out.strip().split('\n')[-1])
+            r['first_prompt_seconds'] = time() - start
+            runs.append(r)
+    finally:
+        shutil.rmtree(workdir)
+    results = { 'config': vars(args), 'modules': runs[-1]['modules'] }
+    for key in ['import_seconds', 'construct_seconds', 'first_prompt_seconds']:
+        results[key] = float(np.median([r[key] for r in runs]))
+    print('import andy     %7.1f ms' % (results['import_seconds'] * 1000))
+    print('Andy()          %7.1f ms' % (results['construct_seconds'] * 1000))
+    print('first prompt    %7.1f ms' % (results['first_prompt_seconds'] * 1000))
+    print('heavy modules   %s' % (', '.join(results['modules']) or 'none'))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import and construction time of Andy in fresh processes')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--out', default='bench_startup.json')
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.out, 'w', encoding='utf-8') as outfile:
+        json.dump(results, outfile, indent=2)
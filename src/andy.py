@@ -1,5 +1,6 @@
+import asyncio
 import os
-from util import open_file, stringify_conversation, clean_embedding_folder, save_file
+from util import open_file, open_prompt, stringify_conversation, clean_embedding_folder, save_file
 from brain.anticipation import Anticipation
 from brain.salience import Salience
 from brain.memory import Memory
@@ -7,35 +8,64 @@ from brain.concept import Concept
 from summary import Summary
 from gpt import EmbeddingFactory, Chat
 from write import Write
-import uuid
+from index import get_index, drop_index
+from journal import Journal
 import json
-import time
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+from tracing import span, in_context
+from context import item_tokens, pack_context, format_items
 
 class Andy(Chat):
-    def __init__(self, api_key, org_key, max_tokens = 4096, max_chat_length = 512):
+    # root is the folder chat_logs/, embeddings/, concepts/ and journal/ are kept in, '' for the working directory
+    # context_budget caps the tokens retrieved memories and concepts add to the system prompt
+    def __init__(self, api_key, org_key, max_tokens = 4096, max_chat_length = 512, max_concurrency = 4, context_refresh_every = 4, root = '', context_budget = 800, memory_candidates = 8, mmr_lambda = 0.7):
         super().__init__(api_key, org_key, 'gpt-3.5-turbo', {
             "max_tokens": max_chat_length
         })
         self._max_tokens = max_tokens
         self._max_chat_length = max_chat_length
-        self._anticipation = Anticipation(api_key, org_key)
-        self._salience = Salience(api_key, org_key)
+        self._context_budget = context_budget
+        self._memory_candidates = memory_candidates
+        self._mmr_lambda = mmr_lambda
+        # what the last turn's context packing kept and dropped
+        self.context_report = None
+        self.root = root
+        self._log_folder = os.path.join(root, 'chat_logs')
+        self._memory_folder = os.path.join(root, 'embeddings')
+        self._concept_folder = os.path.join(root, 'concepts')
+        # independent stages of a turn run on this pool, max_concurrency = 1 runs them serially
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency)
+        # anticipation and salience send only new turns, with the full transcript every context_refresh_every turns
+        self._anticipation = Anticipation(api_key, org_key, context_refresh_every)
+        self._salience = Salience(api_key, org_key, context_refresh_every)
         self._summaryFactory = Summary(api_key, org_key)
         self.embedFactory = EmbeddingFactory(api_key, org_key)
-        self.memories = Memory(api_key, org_key)
-        self.concepts = Concept(api_key, org_key)
-        self.write = Write(api_key, org_key)
+        self.embedFactory.component = 'memory'
+        self.memories = Memory(api_key, org_key, root)
+        self.concepts = Concept(api_key, org_key, root)
+        self.write = Write(api_key, org_key, root)
         self.memory_data = []
         self.concept_data = {
             'add': [],
             'update': []
         }
-        self._default_system_msg = open_file('prompts/prompt_system_default.txt')
-        self._system_context_msg = open_file('prompts/prompt_system_context.txt')
+        # turns are journaled as they happen and stored by save jobs that run one at a time off the request path
+        self._journal = Journal(os.path.join(root, 'journal'))
+        self._saver = ThreadPoolExecutor(max_workers=1)
+        self._last_save = None
+        self._default_system_msg = open_prompt('prompts/prompt_system_default.txt')
+        self._system_context_msg = open_prompt('prompts/prompt_system_context.txt')
 
         self.add_message(self._default_system_msg, 'system')
+        self._recover()
 
-    def send_chat(self, msg, sys_msg = None):
+    # on_token, when given, is called with each piece of the reply as it streams in
+    def send_chat(self, msg, sys_msg = None, on_token = None):
+        with span('send_chat', message_chars=len(msg)):
+            return self._send_chat(msg, sys_msg, on_token)
+
+    def _send_chat(self, msg, sys_msg, on_token):
         self.add_message(msg, 'user')
         system_prompt = self._default_system_msg if sys_msg == None else sys_msg
         anticipation = ''
@@ -44,58 +74,154 @@ class Andy(Chat):
 
         # if there has already been at least one message sent
         if len(self._messages) > 1:
+            # anticipation, memories and salience are independent, concepts wait on salience
             # infer user intent, disposition, valence, needs
             print('Anticipating User needs...')
-            anticipation = self._anticipation.anticipate(self._messages)
+            anticipation_f = self._submit('anticipation', self._anticipation.anticipate, self._messages)
 
             print('Retrieving relevant memories...')
-            memories = self.memories.get_memories(self._messages[0]['content'] + '\nUSER:' + msg)
-            
+            memories_f = self._submit('memory.retrieve', self.memories.get_memories, self._memory_query(msg), self._memory_candidates, msg)
+
             # summarize the conversation to the most salient points
             print('Summarizing salient points of conversation...')
-            salient_points = self._salience.get_salient_points(self._messages)
+            salience_f = self._submit('salience', self._salient_concepts, self._messages)
+
+            anticipation = anticipation_f.result()
+            salient_points, concept_items = salience_f.result()
+            memories, concepts = self._pack_context(memories_f.result(), concept_items)
 
-            print('Retrieving relevant concepts...')
-            concepts = self.concepts.retrieve_concepts(salient_points)
-            
             # update SYSTEM based upon user needs and salience
-            system_prompt += self._system_context_msg\
-                .replace('<<CONVERSATION>>', salient_points)\
-                .replace('<<ANTICIPATION>>', anticipation)\
-                .replace('<<MEMORIES>>', memories)\
-                .replace('<<CONCEPTS>>', concepts)
-        
-        self._messages[0]['content'] = system_prompt
-        print('SYSTEM PROMPT:\n' + system_prompt + '\n\n')
+            system_prompt = self._context_prompt(system_prompt, anticipation, salient_points, memories, concepts)
 
-        # not a perfect calculation but close enough
-        conversation_tokens = len(self._encoding.encode(stringify_conversation(self._messages + [{ 'role': 'user', 'content': msg }])))
-        
         # reset conversation and save conversation
-        if conversation_tokens + self._max_chat_length > self._max_tokens:
+        if self._over_budget(system_prompt):
             print('Reached maximum tokens, summarizing and resetting conversation...')
-            self.save_messages()
-            self._messages.clear()
-            self._total_tokens = 0
-            self.add_message(system_prompt, 'system')
+            self._save_in_background()
+            self._restart_conversation(system_prompt)
 
         # generate a response
         print('Getting bot response...')
-        msg_res = self.run()
+        with span('chat'):
+            if on_token is None:
+                msg_res = self.run()
+            else:
+                for token in self.run_stream():
+                    on_token(token)
+                msg_res = self._messages[-1]['content']
+
+        # post-response work only starts once the whole reply has arrived
+
+        memory_embed, embed_text = self._memory_record(anticipation, salient_points, msg, msg_res)
+        print('Getting embedding for message...')
+        embedding_f = self._submit('memory.embed', self.embedFactory.get_embedding, embed_text)
+
+        print('Updating concepts based on bot response...')
+        concepts_f = self._submit('concepts.update', self.concepts.update_concepts, salient_points, concepts, msg_res, msg)
+
+        self._keep_turn(memory_embed, embedding_f.result(), concepts_f.result())
+        return msg_res
+
+    # asyncio version of send_chat, the stages of a turn run concurrently on the caller's event loop.
+    # anything that blocks on disk or a store's lock runs on a worker thread so other sessions keep going
+    async def asend_chat(self, msg, sys_msg = None, on_token = None):
+        with span('send_chat', message_chars=len(msg)):
+            return await self._asend_chat(msg, sys_msg, on_token)
+
+    async def _asend_chat(self, msg, sys_msg, on_token):
+        self.add_message(msg, 'user')
+        system_prompt = self._default_system_msg if sys_msg == None else sys_msg
+        anticipation = ''
+        salient_points = ''
+        concepts = ''
+
+        if len(self._messages) > 1:
+            print('Anticipating User needs, retrieving memories and summarizing salient points...')
+            anticipation, memory_items, (salient_points, concept_items) = await asyncio.gather(
+                self._astage('anticipation', self._anticipation.aanticipate(self._messages)),
+                self._astage('memory.retrieve', self.memories.aget_memories(self._memory_query(msg), self._memory_candidates, msg)),
+                self._astage('salience', self._asalient_concepts(self._messages))
+            )
+            memories, concepts = self._pack_context(memory_items, concept_items)
+            system_prompt = self._context_prompt(system_prompt, anticipation, salient_points, memories, concepts)
+
+        if self._over_budget(system_prompt):
+            print('Reached maximum tokens, summarizing and resetting conversation...')
+            # rotating the journal waits for its writer to fsync
+            await asyncio.to_thread(self._save_in_background)
+            self._restart_conversation(system_prompt)
+
+        print('Getting bot response...')
+        with span('chat'):
+            if on_token is None:
+                msg_res = await self.arun()
+            else:
+                async for token in self.arun_stream():
+                    on_token(token)
+                msg_res = self._messages[-1]['content']
+
+        memory_embed, embed_text = self._memory_record(anticipation, salient_points, msg, msg_res)
+        print('Getting embedding for message and updating concepts...')
+        embedding, concepts_to_add_or_update = await asyncio.gather(
+            self._astage('memory.embed', self.embedFactory.aget_embedding(embed_text)),
+            self._astage('concepts.update', self.concepts.aupdate_concepts(salient_points, concepts, msg_res, msg))
+        )
+        self._keep_turn(memory_embed, embedding, concepts_to_add_or_update)
+        return msg_res
+
+    # the text memories are embedded against. the BM25 index is only searched for msg, since the
+    # system prompt repeats last turn's memories and would match them again
+    def _memory_query(self, msg):
+        return self._messages[0]['content'] + '\nUSER:' + msg
+
+    # fits the retrieved memories and concepts into the context budget, returns them as prompt lists
+    def _pack_context(self, memory_items, concept_items):
+        taken, report = pack_context(memory_items + concept_items, self._context_budget, self._mmr_lambda)
+        self.context_report = report
+        if len(report['dropped']) > 0:
+            print('Context budget: kept %d items (%d of %d tokens), dropped %s' % (report['taken'], report['tokens'], report['budget'],
+                ', '.join('%s %d (%s, %d tokens)' % (d['kind'], d['id'], d['reason'], d['tokens']) for d in report['dropped'])))
+        return format_items(taken, 'memory'), format_items(taken, 'concept')
 
+    def _context_prompt(self, system_prompt, anticipation, salient_points, memories, concepts):
+        return system_prompt + self._system_context_msg\
+            .replace('<<CONVERSATION>>', salient_points)\
+            .replace('<<ANTICIPATION>>', anticipation)\
+            .replace('<<MEMORIES>>', memories)\
+            .replace('<<CONCEPTS>>', concepts)
+
+    def _over_budget(self, system_prompt):
+        self.set_message(0, system_prompt, 'system')
+        print('SYSTEM PROMPT:\n' + system_prompt + '\n\n')
+
+        # per message token counts are cached, so this only encodes the new system prompt
+        with span('token_budget') as s:
+            conversation_tokens = self.conversation_tokens()
+            s.set('tokens', conversation_tokens)
+        return conversation_tokens + self._max_chat_length > self._max_tokens
+
+    def _restart_conversation(self, system_prompt):
+        self.clear_messages()
+        self._total_tokens = 0
+        self.add_message(system_prompt, 'system')
+        self._reset_context()
+
+    def _memory_record(self, anticipation, salient_points, msg, msg_res):
         memory_embed = {
             'time': str(time()),
             'anticipation': anticipation,
             'salient_points': salient_points,
             'message': msg,
-            'response': msg_res
+            'response': msg_res,
+            'tokens': item_tokens(salient_points)
         }
-        print('Getting embedding for message...')
-        memory_embed['embedding'] = self.embedFactory.get_embedding(json.dumps(memory_embed))
-        self.memory_data.append(memory_embed)
+        # the timestamp and token count are left out of the embedded text so identical turns embed identically
+        embed_text = json.dumps({ k: v for k, v in memory_embed.items() if k != 'time' and k != 'tokens' })
+        return memory_embed, embed_text
 
-        print('Updating concepts based on bot response...')
-        concepts_to_add_or_update = self.concepts.update_concepts(salient_points, concepts, msg_res, msg)
+    def _keep_turn(self, memory_embed, embedding, concepts_to_add_or_update):
+        memory_embed['embedding'] = embedding
+        self._journal.append({ 'memory': memory_embed, 'concepts': concepts_to_add_or_update })
+        self.memory_data.append(memory_embed)
         print('\n\nNew or updated concepts:\n')
         for c in concepts_to_add_or_update['add']:
             print('Added concept: ' + c['data'])
@@ -105,83 +231,161 @@ class Andy(Chat):
         self.concept_data['update'] += concepts_to_add_or_update['update']
 
         print('Current tokens: ' + str(self._total_tokens))
-        return msg_res
     
-    def clean_memories(self):
-        clean_embedding_folder('embeddings', 0.99)
-        clean_embedding_folder('concepts', 0.9)
+    def _salient_concepts(self, conversation):
+        salient_points = self._salience.get_salient_points(conversation)
+        print('Retrieving relevant concepts...')
+        with span('concepts.retrieve'):
+            return salient_points, self.concepts.retrieve_concepts(salient_points)
+
+    async def _asalient_concepts(self, conversation):
+        salient_points = await self._salience.aget_salient_points(conversation)
+        print('Retrieving relevant concepts...')
+        with span('concepts.retrieve'):
+            return salient_points, await self.concepts.aretrieve_concepts(salient_points)
+
+    # runs a stage on the pool inside its own span, nested under the caller's span
+    def _submit(self, stage, fn, *args):
+        def run():
+            with span(stage):
+                return fn(*args)
+        return self._pool.submit(in_context(run))
+
+    async def _astage(self, stage, coro):
+        with span(stage):
+            return await coro
+
+    # the next turn sends the whole transcript to anticipation and salience again
+    def _reset_context(self):
+        self._anticipation.reset()
+        self._salience.reset()
+
+    def clean_memories(self, memory_ids=None, concept_ids=None):
+        clean_embedding_folder(self._memory_folder, 0.99, memory_ids)
+        clean_embedding_folder(self._concept_folder, 0.9, concept_ids)
     
-    def write_document(self):
-        return self.write.write_document(self._messages[0]['content'])
+    # returns the path the document was written to
+    def write_document(self, target_tokens=4000):
+        self.wait_for_saves()
+        return self.write.write_document(self._messages[0]['content'], target_tokens=target_tokens)
 
     def reset(self):
-        self.save_messages()
-        self._messages[0] = self._default_system_msg
+        self._save_in_background()
+        self.set_message(0, self._default_system_msg, 'system')
+        self._reset_context()
 
-    def _save_chat_log(self, t):
-        if len(self._messages) < 2:
+    def _save_chat_log(self, t, messages):
+        if len(messages) < 2:
             return # bail if theres nothing to save
         print('Summarizing conversation...')
-        summary = self._summaryFactory.summarize(self._messages)
-        self._messages[0] = {
-            'role': 'system',
-            'content': self._default_system_msg + \
-                '\nI am continuing from a previous conversation, here is a summary of that conversation:\n' \
-                + summary
-        }
+        summary = self._summaryFactory.summarize(messages)
+        messages = [{ 'role': 'system', 'content': self._default_system_msg + \
+            '\nI am continuing from a previous conversation, here is a summary of that conversation:\n' \
+            + summary }] + messages[1:]
         
         filename = 'chat_%s_user.txt' % t
-        if not os.path.exists('chat_logs'):
-            os.makedirs('chat_logs')
-        conv = stringify_conversation(self._messages)
-        save_file('chat_logs/%s' % filename, conv)
-
-    def _save_embedding(self, t):
-        if not os.path.exists('embeddings'):
-            os.makedirs('embeddings')
-        emb_str = ''
-        for emb in self.memory_data:
-            if emb == '':
-                continue
-            emb_str += json.dumps(emb) + '\n'
-        emb_str = emb_str[:len(emb_str)-1]
-        filename = 'embedding_%s.jsonl' % t
-        if len(emb_str) == 0:
-            return
-        save_file('embeddings/%s' % filename, emb_str)
-
-    def _save_concepts(self):
-        for c in self.concept_data['add']:
-            f_name = 'concept_' + str(uuid.uuid1()) + '.json'
-            if not os.path.exists('concepts'):
-                os.makedirs('concepts')
-            save_file('concepts/' + f_name, json.dumps(c))
-        for c in self.concept_data['update']:
-            os.remove('concepts/' + c['file_name'])
-            save_file('concepts/' + c['file_name'], json.dumps(c))
+        if not os.path.exists(self._log_folder):
+            os.makedirs(self._log_folder)
+        conv = stringify_conversation(messages)
+        save_file(os.path.join(self._log_folder, filename), conv)
+
+    def _save_embedding(self, memory_data):
+        return get_index(self._memory_folder).add([emb for emb in memory_data if emb != ''])
 
+    def _save_concepts(self, concept_data):
+        index = get_index(self._concept_folder)
+        ids = index.add(concept_data['add'])
+        # only the last update to a concept within a batch is kept
+        updates = { c['id']: c for c in concept_data['update'] }
+        for concept_id, c in updates.items():
+            ids.append(index.update(concept_id, c))
+        return ids
+
+    # saves the conversation and everything buffered since the last save, returns once it is stored
     def save_messages(self):
-        t = time()
-        self._save_chat_log(t)
-        self._save_embedding(t)
-        self._save_concepts()
-        self.clean_memories()
+        self._save_in_background().result()
+
+    # hands the conversation and buffers to the save worker and starts new buffers. the
+    # summary call, store writes and deduplication all happen on the worker
+    def _save_in_background(self):
+        messages = list(self._messages)
+        memory_data = self.memory_data
+        concept_data = self.concept_data
+        self.memory_data = []
+        self.concept_data = {
+            'add': [],
+            'update': []
+        }
+        segments = self._journal.rotate()
+        self._last_save = self._saver.submit(in_context(self._save), time(), messages, memory_data, concept_data, segments)
+        self._last_save.add_done_callback(self._report_save)
+        return self._last_save
+
+    def _save(self, t, messages, memory_data, concept_data, segments):
+        with span('save_messages'):
+            with span('save.chat_log'):
+                self._save_chat_log(t, messages)
+            with span('save.memories') as s:
+                memory_ids = self._save_embedding(memory_data)
+                s.set('rows', len(memory_ids))
+            with span('save.concepts') as s:
+                concept_ids = self._save_concepts(concept_data)
+                s.set('rows', len(concept_ids))
+            # the journaled turns are stored now, a crash before this replays them on the next start
+            self._journal.discard(segments)
+            # only rows saved by this call need checking, the rest were deduplicated when they were saved
+            with span('clean'):
+                self.clean_memories(memory_ids, concept_ids)
+
+    def _report_save(self, future):
+        if future.exception() is not None:
+            print('ERROR: saving the conversation failed, its turns are kept in the journal: %s' % future.exception())
+
+    def wait_for_saves(self):
+        if self._last_save is not None:
+            self._last_save.result()
+
+    # buffers turns an earlier run journaled but never stored and starts storing them.
+    # replaying a turn that was stored just before a crash only adds rows the clean drops again
+    def _recover(self):
+        for rec in self._journal.recover():
+            self.memory_data.append(rec['memory'])
+            self.concept_data['add'] += rec['concepts']['add']
+            self.concept_data['update'] += rec['concepts']['update']
+        if len(self.memory_data) > 0:
+            print('Recovering %d journaled turns...' % len(self.memory_data))
+            self._save_in_background()
+
+    # stops the stage workers and the journal and unloads the memory and concept indexes,
+    # saving their BM25 index and codes. the session is not used afterwards
+    def close(self):
+        try:
+            self.wait_for_saves()
+        finally:
+            self._saver.shutdown()
+            self._pool.shutdown()
+            drop_index(self._memory_folder)
+            drop_index(self._concept_folder)
+            self._journal.close()
 
+    # checked once pending saves are done, since the latest chat log may still be being written
     def load(self):
-        if not os.path.exists('chat_logs'):
-            print('Error: there are no chat logs to load')
+        self.wait_for_saves()
+        if not os.path.exists(self._log_folder) or len(os.listdir(self._log_folder)) == 0:
+            raise FileNotFoundError('there are no chat logs to load')
         
         logs = []
-        for l in os.listdir('chat_logs'):
-            edit_time = os.path.getmtime('chat_logs/' + l)
+        for l in os.listdir(self._log_folder):
+            edit_time = os.path.getmtime(os.path.join(self._log_folder, l))
             logs.append((l, edit_time))
         
         def sort_logs(l):
             return l[1]
         logs.sort(key=sort_logs, reverse=True)
         log = logs[0][0]
-        log = open_file('chat_logs/' + log).split('USER:')[0]
-        self._messages[0] = { 'role': 'system', 'content': log }
+        log = open_file(os.path.join(self._log_folder, log)).split('USER:')[0]
+        self.set_message(0, log, 'system')
+        self._reset_context()
         print('Last conversation loaded...')
         return self.send('What were we doing?')
         # return self.send_chat('Summarize the current conversation, be short and concise', log)
@@ -0,0 +1,139 @@
+import os
+import numpy as np
+from tracing import span
+
+# rows per block when assigning vectors to centroids
+ASSIGN_BLOCK = 16384
+
+# inverted file index over the rows of a VectorIndex. every vector belongs to the list of its
+# nearest k-means centroid and a query only scores the rows of its nprobe nearest lists, so
+# raising nprobe trades latency for recall and nprobe = nlist is an exact search. centroids
+# and row assignments are saved next to the store, rows appended after the save are
+# assigned again when it is loaded
+class IVF:
+    def __init__(self, path, centroids, nprobe):
+        self.path = path
+        self.centroids = centroids
+        self.nlist = len(centroids)
+        self.nprobe = nprobe
+        self.generation = 0
+        self._assign = np.zeros(0, dtype=np.int32)
+        self._lists = [np.zeros(0, dtype=np.int64) for _ in range(self.nlist)]
+
+    def __len__(self):
+        return len(self._assign)
+
+    # assigns rows appended to the store, vectors are the new rows only
+    def add(self, vectors, norms):
+        start = len(self._assign)
+        assign = self._nearest(vectors, norms)
+        self._assign = np.concatenate([self._assign, assign])
+        for l in np.unique(assign):
+            self._lists[l] = np.concatenate([self._lists[l], start + np.flatnonzero(assign == l)])
+
+    # follows a compaction of the store, order holds the old row of every new row
+    def reorder(self, order, generation):
+        self._assign = self._assign[order]
+        self.generation = generation
+        self._build_lists()
+
+    # sorted rows of the nprobe lists whose centroids are closest to the unit query
+    def candidates(self, q, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        sims = self.centroids @ q
+        probe = np.argpartition(-sims, nprobe - 1)[:nprobe]
+        rows = np.concatenate([self._lists[l] for l in probe])
+        rows.sort()
+        return rows
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as outfile:
+            np.savez(outfile, centroids=self.centroids, assign=self._assign, generation=self.generation)
+        os.replace(tmp, self.path)
+
+    def _nearest(self, vectors, norms):
+        assign = np.zeros(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), ASSIGN_BLOCK):
+            block = np.asarray(vectors[start:start + ASSIGN_BLOCK]) / norms[start:start + ASSIGN_BLOCK][:, None]
+            assign[start:start + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        return assign
+
+    def _build_lists(self):
+        order = np.argsort(self._assign, kind='stable')
+        bounds = np.searchsorted(self._assign[order], np.arange(self.nlist + 1))
+        self._lists = [order[bounds[l]:bounds[l + 1]].astype(np.int64) for l in range(self.nlist)]
+
+# loads the saved index of a store or trains a new one, then assigns any rows it does not cover
+def open_ivf(folder, vectors, norms, live, generation, config):
+    path = folder + '/ivf.npz'
+    ivf = None
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            if saved['centroids'].shape[1] == vectors.shape[1]:
+                ivf = IVF(path, saved['centroids'], config['nprobe'])
+                ivf.generation = int(saved['generation'])
+                # assignments of another generation point at rows that have moved
+                if ivf.generation == generation and len(saved['assign']) <= len(vectors):
+                    ivf._assign = saved['assign']
+                    ivf._build_lists()
+    if ivf is None:
+        ivf = train_ivf(path, vectors, norms, live, config)
+    ivf.generation = generation
+    start = len(ivf)
+    if start < len(vectors):
+        with span('ivf.assign', rows=len(vectors) - start):
+            ivf.add(vectors[start:], norms[start:])
+        ivf.save()
+    return ivf
+
+# spherical k-means on a sample of the live rows
+def train_ivf(path, vectors, norms, live, config):
+    rows = np.flatnonzero(live)
+    nlist = config['nlist'] or max(1, int(np.sqrt(len(rows))))
+    nlist = min(nlist, len(rows))
+    with span('ivf.train', rows=len(rows), nlist=nlist):
+        rng = np.random.default_rng(config['seed'])
+        if len(rows) > config['train_sample']:
+            rows = np.sort(rng.choice(rows, config['train_sample'], replace=False))
+        sample = np.asarray(vectors[rows]) / norms[rows][:, None]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(config['iterations']):
+            assign = np.zeros(len(sample), dtype=np.int64)
+            for start in range(0, len(sample), ASSIGN_BLOCK):
+                assign[start:start + ASSIGN_BLOCK] = np.argmax(sample[start:start + ASSIGN_BLOCK] @ centroids.T, axis=1)
+            order = np.argsort(assign, kind='stable')
+            counts = np.bincount(assign, minlength=nlist)
+            starts = np.minimum(np.concatenate([[0], np.cumsum(counts)[:-1]]), len(sample) - 1)
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            lengths = np.linalg.norm(sums, axis=1)
+            # empty lists are restarted from random sample rows
+            empty = np.flatnonzero((counts == 0) | (lengths == 0))
+            sums[empty] = sample[rng.choice(len(sample), len(empty))]
+            lengths[empty] = 1
+            centroids = (sums / lengths[:, None]).astype(np.float32)
+        return IVF(path, centroids, config['nprobe'])
+
+_config = None
+
+# stores with at least min_rows live rows are searched through an IVF index. nlist = None
+# uses sqrt(rows) lists, nprobe is how many lists a query scores
+def enable_ann(nprobe=16, nlist=None, min_rows=100000, iterations=10, train_sample=65536, seed=0):
+    global _config
+    _config = {
+        'nprobe': nprobe,
+        'nlist': nlist,
+        'min_rows': min_rows,
+        'iterations': iterations,
+        'train_sample': train_sample,
+        'seed': seed
+    }
+    return _config
+
+def disable_ann():
+    global _config
+    _config = None
+
+# None unless enable_ann() was called
+def get_ann_config():
+    return _config
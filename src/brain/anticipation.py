@@ -1,13 +1,24 @@
-from gpt import GptCompletion, completion_config
-from util import open_file, stringify_conversation
+from brain.rolling import RollingCompletion
+from util import open_prompt
 
-class Anticipation(GptCompletion):
-    def __init__(self, api_key, org_key):
-        super().__init__(api_key, org_key, 'text-davinci-003')
-        self._anticipation_prompt = open_file('prompts/prompt_anticipate.txt')
-        self._prompt_tokens = len(self._encoding.encode(self._anticipation_prompt))
+class Anticipation(RollingCompletion):
+    def __init__(self, api_key, org_key, refresh_every=4):
+        super().__init__(
+            api_key,
+            org_key,
+            'anticipation',
+            open_prompt('prompts/prompt_anticipate.txt'),
+            open_prompt('prompts/prompt_anticipate_update.txt'),
+            refresh_every
+        )
+        self._anticipation_prompt = self._full_prompt
+
+    @property
+    def _prompt_tokens(self):
+        return len(self._encoding.encode(self._anticipation_prompt))
 
     def anticipate(self, conversation):
-        conv_s = stringify_conversation(conversation)
-        prompt = self._anticipation_prompt.replace('<<INPUT>>', conv_s)
-        return self.complete(prompt, completion_config)
\ No newline at end of file
+        return self.roll(conversation)
+
+    async def aanticipate(self, conversation):
+        return await self.aroll(conversation)
\ No newline at end of file
@@ -1,49 +1,97 @@
+import asyncio
+import os
 from gpt import GptCompletion, EmbeddingFactory, completion_config
-from util import open_file, get_closest_embeddings
+from util import open_prompt, get_closest_embeddings, get_lexical_matches
+from context import context_items, item_tokens
 
 class Concept(GptCompletion):
-    def __init__(self, api_key, org_key):
+    def __init__(self, api_key, org_key, root=''):
         super().__init__(api_key, org_key, 'text-davinci-003')
+        self.component = 'concepts'
+        self.folder = os.path.join(root, 'concepts')
         self.embeddingFactory = EmbeddingFactory(api_key, org_key)
-        self._retrieve_prompt = open_file('prompts/prompt_concept_retrieve.txt')
-        self._update_prompt = open_file('prompts/prompt_concept_update.txt')
+        self.embeddingFactory.component = 'concepts'
+        self._retrieve_prompt = open_prompt('prompts/prompt_concept_retrieve.txt')
+        self._update_prompt = open_prompt('prompts/prompt_concept_update.txt')
 
+    # the closest concept to each key the model comes up with, as context items, see pack_context
     def retrieve_concepts(self, salient_points):
-        prompt = self._retrieve_prompt.replace('<<INPUT>>', salient_points)
-        concept_keys = self.complete(prompt, completion_config).split('\n')
-        concepts = ''
+        concept_keys = self._concept_keys(self.complete(self._retrieve(salient_points), completion_config))
+        missing = self._unmatched(concept_keys)
+        return self._closest_concepts(concept_keys, dict(zip(missing, self.embeddingFactory.get_embeddings(missing))))
+
+    # index searches wait on the store's lock, so they run on a worker thread
+    async def aretrieve_concepts(self, salient_points):
+        concept_keys = self._concept_keys(await self.acomplete(self._retrieve(salient_points), completion_config))
+        missing = await asyncio.to_thread(self._unmatched, concept_keys)
+        q_embeds = dict(zip(missing, await self.embeddingFactory.aget_embeddings(missing)))
+        return await asyncio.to_thread(self._closest_concepts, concept_keys, q_embeds)
+
+    def update_concepts(self, salient_points, retrieved_concepts, bot_message, user_message):
+        prompt = self._update(salient_points, retrieved_concepts, bot_message, user_message)
+        concepts_to_update = self._concept_changes(self.complete(prompt, completion_config))
+        return self._sort_changes(self.embed_concepts(concepts_to_update))
+
+    async def aupdate_concepts(self, salient_points, retrieved_concepts, bot_message, user_message):
+        prompt = self._update(salient_points, retrieved_concepts, bot_message, user_message)
+        concepts_to_update = self._concept_changes(await self.acomplete(prompt, completion_config))
+        return await asyncio.to_thread(self._sort_changes, await self.aembed_concepts(concepts_to_update))
+
+    def _retrieve(self, salient_points):
+        return self._retrieve_prompt.replace('<<INPUT>>', salient_points)
+
+    def _concept_keys(self, completion):
+        return [c for c in completion.split('\n') if len(c.strip()) > 0]
+
+    # keys the BM25 index has no match for, only those are embedded
+    def _unmatched(self, concept_keys):
+        return [c for c in concept_keys if len(get_lexical_matches(self.folder, c, 1)) == 0]
+
+    # q_embeds holds the embedding of every key that has to be searched by vector
+    def _closest_concepts(self, concept_keys, q_embeds):
+        found = []
         concept_list = []
         for c in concept_keys:
             print('Attempting to retrieve concept: ' + c)
-            q_embed = self.embeddingFactory.get_embedding(c)
-            most_similar = get_closest_embeddings('concepts', q_embed, 1, concept_list, 'data')
+            if c in q_embeds:
+                most_similar = get_closest_embeddings(self.folder, q_embeds[c], 1, concept_list, 'data', c)
+            else:
+                most_similar = get_lexical_matches(self.folder, c, 1, concept_list, 'data')
             if len(most_similar) == 0:
                 continue
             concept_list.append(most_similar[0][1]['data'])
-            concepts += '\n- ' + most_similar[0][1]['data']
-        return concepts
-    
-    def update_concepts(self, salient_points, retrieved_concepts, bot_message, user_message):
-        prompt = self._update_prompt\
+            found.append(most_similar[0])
+        return context_items('concept', self.folder, found)
+
+    def _update(self, salient_points, retrieved_concepts, bot_message, user_message):
+        return self._update_prompt\
             .replace('<<SALIENT_POINTS>>', salient_points)\
             .replace('<<CONCEPTS>>', retrieved_concepts)\
             .replace('<<CHAT_MESSAGE>>', bot_message)\
             .replace('<<USER_MESSAGE>>', user_message)
-        concepts_to_update = self.complete(prompt, completion_config).split('\n')
+
+    # lines that are neither an add nor an update are never used, so they are not embedded
+    def _concept_changes(self, completion):
+        return [c for c in completion.split('\n') if 'add' in c.lower() or 'update' in c.lower()]
+
+    def _sort_changes(self, embedded):
         add_concepts = []
         update_concepts = []
-        for c in concepts_to_update:
-            c_embed_o = self.embed_concept(c)
+        for c_embed_o in embedded:
+            c = c_embed_o['data']
             if 'add' in c.lower():
                 c_embed_o['data'] = c_embed_o['data'].replace('Add', '')
                 add_concepts.append(c_embed_o)
             if 'update' in c.lower():
                 c_embed_o['data'] = c_embed_o['data'].replace('Update', '')
-                c_to_update = get_closest_embeddings('concepts', c_embed_o['embedding'], 1)
+                c_to_update = get_closest_embeddings(self.folder, c_embed_o['embedding'], 1)
                 if len(c_to_update) == 0:
                     continue
-                c_embed_o['file_name'] = c_to_update[0][1]['file_name']
+                c_embed_o['id'] = c_to_update[0][1]['id']
                 update_concepts.append(c_embed_o)
+        # counted once here so packing the context never has to encode stored concepts
+        for c_embed_o in add_concepts + update_concepts:
+            c_embed_o['tokens'] = item_tokens(c_embed_o['data'])
         return {
             'add': add_concepts,
             'update': update_concepts
@@ -54,4 +102,12 @@ class Concept(GptCompletion):
         return {
             'data': concept,
             'embedding': c_embed
-        }
\ No newline at end of file
+        }
+
+    def embed_concepts(self, concepts):
+        c_embeds = self.embeddingFactory.get_embeddings(concepts)
+        return [{ 'data': c, 'embedding': e } for c, e in zip(concepts, c_embeds)]
+
+    async def aembed_concepts(self, concepts):
+        c_embeds = await self.embeddingFactory.aget_embeddings(concepts)
+        return [{ 'data': c, 'embedding': e } for c, e in zip(concepts, c_embeds)]
\ No newline at end of file
@@ -1,14 +1,29 @@
+import asyncio
+import os
 from gpt import EmbeddingFactory
-from util import get_closest_embeddings
+from util import get_closest_embeddings, get_lexical_matches
+from context import context_items
 
 class Memory(EmbeddingFactory):
-    def __init__(self, api_key, org_key):
+    def __init__(self, api_key, org_key, root=''):
         super().__init__(api_key, org_key)
+        self.component = 'memory'
+        self.folder = os.path.join(root, 'embeddings')
 
-    def get_memories(self, query, top_n=3):
-        q_embed = self.get_embedding(query)
-        most_similar = get_closest_embeddings('embeddings', q_embed, top_n)
-        memories = ''
-        for o in most_similar:
-            memories += '\n- ' + o[1]['salient_points']
-        return memories
\ No newline at end of file
+    # the top_n closest memories as context items, see pack_context. query is embedded, text
+    # is what the BM25 index is searched for and defaults to query
+    def get_memories(self, query, top_n=8, text=None):
+        text = query if text is None else text
+        most_similar = get_lexical_matches(self.folder, text, top_n)
+        if len(most_similar) == 0:
+            most_similar = get_closest_embeddings(self.folder, self.get_embedding(query), top_n, text=text)
+        return context_items('memory', self.folder, most_similar)
+
+    # index searches wait on the store's lock, so they run on a worker thread
+    async def aget_memories(self, query, top_n=8, text=None):
+        text = query if text is None else text
+        most_similar = await asyncio.to_thread(get_lexical_matches, self.folder, text, top_n)
+        if len(most_similar) == 0:
+            q_embed = await self.aget_embedding(query)
+            most_similar = await asyncio.to_thread(get_closest_embeddings, self.folder, q_embed, top_n, text=text)
+        return await asyncio.to_thread(context_items, 'memory', self.folder, most_similar)
\ No newline at end of file
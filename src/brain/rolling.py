@@ -0,0 +1,52 @@
+from gpt import GptCompletion, completion_config
+from util import stringify_conversation
+
+# keeps the last result and only sends the messages added since it was produced,
+# the whole transcript is sent again every refresh_every updates and after reset().
+# refresh_every = 0 sends the whole transcript every time
+class RollingCompletion(GptCompletion):
+    def __init__(self, api_key, org_key, component, full_prompt, update_prompt, refresh_every=4):
+        super().__init__(api_key, org_key, 'text-davinci-003')
+        self.component = component
+        self._full_prompt = full_prompt
+        self._update_prompt = update_prompt
+        self.refresh_every = refresh_every
+        self.reset()
+
+    def reset(self):
+        self._result = None
+        self._seen = 0
+        self._updates = 0
+
+    def roll(self, conversation):
+        prompt = self._next_prompt(conversation)
+        if prompt is None:
+            return self._result
+        return self._keep(self.complete(prompt, completion_config), conversation)
+
+    async def aroll(self, conversation):
+        prompt = self._next_prompt(conversation)
+        if prompt is None:
+            return self._result
+        return self._keep(await self.acomplete(prompt, completion_config), conversation)
+
+    # None when nothing was added since the last result
+    def _next_prompt(self, conversation):
+        if self._result is not None and len(conversation) == self._seen:
+            return None
+        if self._result is None or self.refresh_every == 0 \
+            or self._updates >= self.refresh_every \
+            or len(conversation) < self._seen:
+            prompt = self._full_prompt.replace('<<INPUT>>', stringify_conversation(conversation))
+            self._updates = 0
+        else:
+            prompt = self._update_prompt\
+                .replace('<<PREVIOUS>>', self._result)\
+                .replace('<<INPUT>>', stringify_conversation(conversation[self._seen:]))
+            self._updates += 1
+        return prompt
+
+    def _keep(self, result, conversation):
+        self._result = result
+        self._seen = len(conversation)
+        return self._result
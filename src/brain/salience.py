@@ -1,13 +1,24 @@
-from gpt import GptCompletion, completion_config
-from util import open_file, stringify_conversation
+from brain.rolling import RollingCompletion
+from util import open_prompt
 
-class Salience(GptCompletion):
-    def __init__(self, api_key, org_key):
-        super().__init__(api_key, org_key, 'text-davinci-003')
-        self._salience_prompt = open_file('prompts/prompt_salience.txt')
-        self._prompt_tokens = len(self._encoding.encode(self._salience_prompt))
+class Salience(RollingCompletion):
+    def __init__(self, api_key, org_key, refresh_every=4):
+        super().__init__(
+            api_key,
+            org_key,
+            'salience',
+            open_prompt('prompts/prompt_salience.txt'),
+            open_prompt('prompts/prompt_salience_update.txt'),
+            refresh_every
+        )
+        self._salience_prompt = self._full_prompt
+
+    @property
+    def _prompt_tokens(self):
+        return len(self._encoding.encode(self._salience_prompt))
 
     def get_salient_points(self, conversation):
-        conv_s = stringify_conversation(conversation)
-        prompt = self._salience_prompt.replace('<<INPUT>>', conv_s)
-        return self.complete(prompt, completion_config)
\ No newline at end of file
+        return self.roll(conversation)
+
+    async def aget_salient_points(self, conversation):
+        return await self.aroll(conversation)
\ No newline at end of file
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from time import time
+import numpy as np
+
+EMBEDDING_CACHE_PATH = 'cache/embeddings.db'
+COMPLETION_CACHE_PATH = 'cache/completions.db'
+# disk hits whose last use is written in one transaction, the next put writes them sooner
+TOUCH_BATCH = 256
+
+# embeddings keyed by a hash of (model, input), with an in-process LRU in front of
+# an sqlite file. both tiers are bounded and evict the least recently used entries.
+# disk hits only read, their last use is written with the next put or TOUCH_BATCH hits
+class EmbeddingCache:
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_memory_entries=10000, max_disk_entries=1000000):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_entries = 0
+        # key -> last use of disk hits not written yet
+        self._touched = { }
+
+    def key(self, model, text):
+        return hashlib.sha256((model + '\0' + text).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return self._lru[key].tolist()
+            db = self._open()
+            row = db.execute('SELECT embedding FROM embeddings WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._touched[key] = time()
+            if len(self._touched) >= TOUCH_BATCH:
+                self._write_touched(db)
+                db.commit()
+            embedding = np.frombuffer(row[0], dtype=np.float32)
+            self._remember(key, embedding)
+            self.hits += 1
+            return embedding.tolist()
+
+    def put(self, key, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._remember(key, embedding)
+            db = self._open()
+            exists = db.execute('SELECT 1 FROM embeddings WHERE key = ?', (key,)).fetchone() is not None
+            db.execute('INSERT OR REPLACE INTO embeddings (key, embedding, used) VALUES (?, ?, ?)',
+                (key, embedding.tobytes(), time()))
+            if not exists:
+                self._disk_entries += 1
+            self._touched.pop(key, None)
+            self._write_touched(db)
+            if self._disk_entries > self.max_disk_entries:
+                db.execute('DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used LIMIT ?)',
+                    (self._disk_entries - self.max_disk_entries,))
+                self._disk_entries = self.max_disk_entries
+            db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'memory_entries': len(self._lru),
+                'disk_entries': self._disk_entries if self._db is not None else None
+            }
+
+    def _write_touched(self, db):
+        if len(self._touched) > 0:
+            db.executemany('UPDATE embeddings SET used = ? WHERE key = ?', [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+
+    def _remember(self, key, embedding):
+        self._lru[key] = embedding
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_memory_entries:
+            self._lru.popitem(last=False)
+
+    def _open(self):
+        if self._db is None:
+            folder = os.path.dirname(self.path)
+            if folder != '' and not os.path.exists(folder):
+                os.makedirs(folder)
+            # the lock serializes access, so the connection can be shared by the turn's worker threads
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB, used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)')
+            self._disk_entries = self._db.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        return self._db
+
+_embedding_cache = None
+
+# every EmbeddingFactory shares one cache per process
+def get_embedding_cache():
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache()
+    return _embedding_cache
+
+# replaces the shared cache, factories created afterwards use the new one
+def configure_embedding_cache(**kwargs):
+    global _embedding_cache
+    _embedding_cache = EmbeddingCache(**kwargs)
+    return _embedding_cache
+
+# completion text keyed by a hash of (model, prompt, config). only deterministic,
+# temperature 0 requests are cached, and the cache is off until enabled. bounded the
+# same way as EmbeddingCache
+class CompletionCache:
+    def __init__(self, path=COMPLETION_CACHE_PATH, max_memory_entries=1000, max_disk_entries=100000):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_entries = 0
+        # key -> last use of disk hits not written yet
+        self._touched = { }
+
+    def key(self, model, prompt, config):
+        return hashlib.sha256(json.dumps([model, prompt, config], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def cacheable(self, config):
+        return config.get('temperature', 1) == 0 and config.get('n', 1) == 1
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            db = self._open()
+            row = db.execute('SELECT completion FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._touched[key] = time()
+            if len(self._touched) >= TOUCH_BATCH:
+                self._write_touched(db)
+                db.commit()
+            self._remember(key, row[0])
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, completion):
+        with self._lock:
+            self._remember(key, completion)
+            db = self._open()
+            exists = db.execute('SELECT 1 FROM completions WHERE key = ?', (key,)).fetchone() is not None
+            db.execute('INSERT OR REPLACE INTO completions (key, completion, used) VALUES (?, ?, ?)', (key, completion, time()))
+            if not exists:
+                self._disk_entries += 1
+            self._touched.pop(key, None)
+            self._write_touched(db)
+            if self._disk_entries > self.max_disk_entries:
+                db.execute('DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY used LIMIT ?)',
+                    (self._disk_entries - self.max_disk_entries,))
+                self._disk_entries = self.max_disk_entries
+            db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'memory_entries': len(self._memory),
+                'disk_entries': self._disk_entries if self._db is not None else None
+            }
+
+    def _write_touched(self, db):
+        if len(self._touched) > 0:
+            db.executemany('UPDATE completions SET used = ? WHERE key = ?', [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+
+    def _remember(self, key, completion):
+        self._memory[key] = completion
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _open(self):
+        if self._db is None:
+            folder = os.path.dirname(self.path)
+            if folder != '' and not os.path.exists(folder):
+                os.makedirs(folder)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, completion TEXT, used REAL)')
+            # caches written before entries were bounded have no last use, they are evicted first
+            if 'used' not in [c[1] for c in self._db.execute('PRAGMA table_info(completions)')]:
+                self._db.execute('ALTER TABLE completions ADD COLUMN used REAL DEFAULT 0')
+            self._db.execute('CREATE INDEX IF NOT EXISTS completions_used ON completions (used)')
+            self._disk_entries = self._db.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+        return self._db
+
+_completion_cache = None
+
+def enable_completion_cache(path=COMPLETION_CACHE_PATH, **kwargs):
+    global _completion_cache
+    _completion_cache = CompletionCache(path, **kwargs)
+    return _completion_cache
+
+def disable_completion_cache():
+    global _completion_cache
+    _completion_cache = None
+
+# None unless enable_completion_cache() was called
+def get_completion_cache():
+    return _completion_cache
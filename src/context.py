@@ -0,0 +1,99 @@
+import numpy as np
+from gpt import get_encoding
+from index import get_index
+from tracing import span
+
+# the model the packed context is sent to, token counts are made with its encoder
+CONTEXT_MODEL = 'gpt-3.5-turbo'
+TEXT_FIELDS = {
+    'memory': 'salient_points',
+    'concept': 'data'
+}
+
+# tokens an item adds to the system prompt as a '- ' list line, stored with every memory and concept
+def item_tokens(text):
+    return len(get_encoding(CONTEXT_MODEL).encode('\n- ' + text))
+
+# retrieved (score, meta) pairs of one store as items for pack_context, with their stored vectors
+def context_items(kind, folder, most_similar):
+    if len(most_similar) == 0:
+        return []
+    vectors = get_index(folder).vectors([m['id'] for _, m in most_similar])
+    items = []
+    for (score, meta), vector in zip(most_similar, vectors):
+        text = meta[TEXT_FIELDS[kind]]
+        items.append({
+            'kind': kind,
+            'id': meta['id'],
+            'text': text,
+            # records saved before token counts were stored are counted now
+            'tokens': meta['tokens'] if 'tokens' in meta else item_tokens(text),
+            'score': score,
+            'vector': vector
+        })
+    return items
+
+# picks items by maximal marginal relevance until budget tokens are used. each step takes
+# the item with the best mmr_lambda * relevance - (1 - mmr_lambda) * its highest similarity
+# to an item already taken. items more similar than max_sim to a taken item or too long for
+# what is left of the budget are dropped. relevance is the retrieval score scaled to the best
+# item of the same kind, since stores can be searched by cosine similarity or BM25. returns
+# the taken items in the order they were picked and a report of what was kept and dropped
+def pack_context(items, budget, mmr_lambda=0.7, max_sim=0.95):
+    with span('context.pack', candidates=len(items), budget=budget) as s:
+        taken = []
+        dropped = []
+        used = 0
+        if len(items) > 0:
+            vectors = np.array([i['vector'] for i in items], dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1)
+            norms[norms == 0] = 1
+            vectors /= norms[:, None]
+            sims = vectors @ vectors.T
+            best = { }
+            for i in items:
+                best[i['kind']] = max(best.get(i['kind'], 0), i['score'])
+            relevance = np.array([i['score'] / best[i['kind']] if best[i['kind']] > 0 else 0 for i in items])
+            # highest similarity of every item to the taken ones
+            redundancy = np.full(len(items), -np.inf)
+            remaining = np.ones(len(items), dtype=bool)
+            while remaining.any():
+                mmr = mmr_lambda * relevance - (1 - mmr_lambda) * np.maximum(redundancy, 0)
+                mmr[~remaining] = -np.inf
+                i = int(np.argmax(mmr))
+                remaining[i] = False
+                item = items[i]
+                if redundancy[i] > max_sim:
+                    dropped.append(_dropped(item, 'duplicate'))
+                    continue
+                if used + item['tokens'] > budget:
+                    dropped.append(_dropped(item, 'budget'))
+                    continue
+                taken.append(item)
+                used += item['tokens']
+                redundancy = np.maximum(redundancy, sims[i])
+        s.set('tokens', used)
+        s.set('taken', len(taken))
+        s.set('dropped', len(dropped))
+        return taken, {
+            'budget': budget,
+            'tokens': used,
+            'taken': len(taken),
+            'dropped': dropped
+        }
+
+def _dropped(item, reason):
+    return {
+        'kind': item['kind'],
+        'id': item['id'],
+        'tokens': item['tokens'],
+        'reason': reason
+    }
+
+# the taken items of one kind as the list lines of the system prompt
+def format_items(items, kind):
+    s = ''
+    for i in items:
+        if i['kind'] == kind:
+            s += '\n- ' + i['text']
+    return s
@@ -1,6 +1,12 @@
-import tiktoken
-import requests
+import asyncio
 import json
+import threading
+import unicodedata
+from cache import get_embedding_cache, get_completion_cache
+from transport import get_transport, get_async_transport
+from usage import get_usage_ledger
+from tracing import span
+from time import time
 
 completion_config = {
     'temperature': 0,
@@ -8,6 +14,18 @@ completion_config = {
     'stop': ['USER:', 'RAVEN:']
 }
 
+_encodings = { }
+_encodings_lock = threading.Lock()
+
+# encoders are loaded on first use and shared by every instance in the process,
+# tiktoken itself is only imported then
+def get_encoding(model):
+    with _encodings_lock:
+        if model not in _encodings:
+            import tiktoken
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        return _encodings[model]
+
 class GptCompletion:
     def __init__(self, api_key, org, model) -> None:
         self.api_key = api_key
@@ -16,35 +34,64 @@ class GptCompletion:
         self.prompt_tokens = 0
         self.completion_tokens = 0
         self.total_tokens = 0
-        self._encoding = tiktoken.encoding_for_model(self.model)
+        # name usage is recorded under in the usage ledger
+        self.component = 'completion'
+
+    @property
+    def _encoding(self):
+        return get_encoding(self.model)
 
     def complete(self, prompt, config={}):
+        defaultConfig, key, msg = self._lookup(prompt, config)
+        if msg is not None:
+            return msg
+        start = time()
+        with span('http.completions', component=self.component, model=self.model) as s:
+            res = get_transport().post('/completions', self.api_key, self.org, defaultConfig)
+            return self._read_completion(res, start, s, key)
+
+    async def acomplete(self, prompt, config={}):
+        defaultConfig, key, msg = self._lookup(prompt, config)
+        if msg is not None:
+            return msg
+        start = time()
+        with span('http.completions', component=self.component, model=self.model) as s:
+            res = await get_async_transport().post('/completions', self.api_key, self.org, defaultConfig)
+            return self._read_completion(res, start, s, key)
+
+    # returns the request config, the completion cache key if the request is cacheable and any cached text
+    def _lookup(self, prompt, config):
         defaultConfig = {
             "model": self.model,
             "prompt": prompt
         }
 
         defaultConfig.update(config)
-        res = requests.post('https://api.openai.com/v1/completions', 
-            headers={
-                'Authorization': 'Bearer ' + self.api_key,
-                'OpenAI-Organization': self.org
-            },
-            json = defaultConfig
-        ).json()
+        cache = get_completion_cache()
+        if cache is None or not cache.cacheable(defaultConfig):
+            return defaultConfig, None, None
+        key = cache.key(self.model, prompt, config)
+        msg = cache.get(key)
+        if msg is not None:
+            get_usage_ledger().record(self.component, cached=True)
+        return defaultConfig, key, msg
+
+    def _read_completion(self, res, start, s, key):
         if res.get('error') is not None:
-            if 'overloaded' in res.get('error').get('message'):
-                print('ERROR: Server overloaded. Retrying request...')
-                self.complete(self, prompt, config)
             raise SyntaxError("error getting chat message: " + res.get('error').get('message'))
-        # self.prompt_tokens += res.get('usage').get('prompt_tokens')
-        # self.completion_tokens += res.get('usage').get('completion_tokens')
-        # self.total_tokens += res.get('usage').get('total_tokens')
-        print('TOKENS')
-        print(res.get('usage').get('prompt_tokens'))
-        print(res.get('usage').get('completion_tokens'))
-        print(res.get('usage').get('total_tokens'))
+        s.set('prompt_tokens', res.get('usage').get('prompt_tokens'))
+        s.set('completion_tokens', res.get('usage').get('completion_tokens'))
+        self.prompt_tokens += res.get('usage').get('prompt_tokens')
+        self.completion_tokens += res.get('usage').get('completion_tokens')
+        self.total_tokens += res.get('usage').get('total_tokens')
+        get_usage_ledger().record(self.component,
+            res.get('usage').get('prompt_tokens'),
+            res.get('usage').get('completion_tokens'),
+            time() - start)
         msg = res.get('choices')[0].get('text')
+        cache = get_completion_cache()
+        if key is not None and cache is not None:
+            cache.put(key, msg)
         return msg
 
 class Chat:
@@ -59,15 +106,56 @@ class Chat:
         self.org = org
         self.model = model
         self.config = config
-        self._encoding = tiktoken.encoding_for_model(self.model)
+
+        self.component = 'chat'
 
         # total tokens of the conversation updated every chat message
         self._total_tokens = 0
         self._messages = []
+        # estimated tokens of each message in _messages, None until they are first needed, and
+        # the running sum of the known ones, so messages must be changed through add_message,
+        # set_message and clear_messages
+        self._message_tokens = []
+        self._conversation_tokens = 0
+
+    @property
+    def _encoding(self):
+        return get_encoding(self.model)
 
     def add_message(self, msg, role):
-        self._messages.append({ 'role': role, 'content': msg})
-    
+        self._append_message({ 'role': role, 'content': msg})
+
+    def set_message(self, idx, msg, role):
+        if self._message_tokens[idx] is not None:
+            self._conversation_tokens -= self._message_tokens[idx]
+        self._messages[idx] = { 'role': role, 'content': msg }
+        self._message_tokens[idx] = None
+
+    def clear_messages(self):
+        self._messages.clear()
+        self._message_tokens.clear()
+        self._conversation_tokens = 0
+
+    # not a perfect calculation but close enough, matches the length of stringify_conversation.
+    # only messages added or changed since the last call are encoded
+    def conversation_tokens(self):
+        for idx in range(len(self._messages)):
+            self._message_token_count(idx)
+        return self._conversation_tokens
+
+    def _append_message(self, message):
+        self._messages.append(message)
+        self._message_tokens.append(None)
+
+    def _message_token_count(self, idx):
+        if self._message_tokens[idx] is None:
+            self._message_tokens[idx] = self._count_message_tokens(self._messages[idx])
+            self._conversation_tokens += self._message_tokens[idx]
+        return self._message_tokens[idx]
+
+    def _count_message_tokens(self, message):
+        return len(self._encoding.encode('%s: %s' % (message['role'].upper(), message['content']))) + 1
+
     def send(self, msg, role="user"):
         if self.api_key is None or \
             self.org is None or \
@@ -78,48 +166,200 @@ class Chat:
         return self.run()
 
     def run(self):
+        start = time()
+        with span('http.chat_completions', component=self.component, model=self.model) as s:
+            res = get_transport().post('/chat/completions', self.api_key, self.org, self._chat_config())
+            return self._read_reply(res, start, s)
+
+    async def arun(self):
+        start = time()
+        with span('http.chat_completions', component=self.component, model=self.model) as s:
+            res = await get_async_transport().post('/chat/completions', self.api_key, self.org, self._chat_config())
+            return self._read_reply(res, start, s)
+
+    # like run() but yields the reply's content as it arrives, the assembled
+    # message is added to the conversation once the stream is finished
+    def run_stream(self):
+        prompt_tokens = self.conversation_tokens()
+        role = 'assistant'
+        parts = []
+        start = time()
+        with span('http.chat_completions', component=self.component, model=self.model, stream=True) as s:
+            for event in get_transport().post_stream('/chat/completions', self.api_key, self.org, self._chat_config(True)):
+                role, content = self._read_delta(event, role)
+                if content:
+                    parts.append(content)
+                    yield content
+            self._finish_stream(role, parts, prompt_tokens, start, s)
+
+    async def arun_stream(self):
+        prompt_tokens = self.conversation_tokens()
+        role = 'assistant'
+        parts = []
+        start = time()
+        with span('http.chat_completions', component=self.component, model=self.model, stream=True) as s:
+            async for event in get_async_transport().post_stream('/chat/completions', self.api_key, self.org, self._chat_config(True)):
+                role, content = self._read_delta(event, role)
+                if content:
+                    parts.append(content)
+                    yield content
+            self._finish_stream(role, parts, prompt_tokens, start, s)
+
+    def _chat_config(self, stream=False):
         cfg = {
             "model": self.model,
             "messages": self._messages
         }
+        if stream:
+            cfg['stream'] = True
         cfg.update(self.config)
-        res = requests.post('https://api.openai.com/v1/chat/completions', 
-            headers={
-                'Authorization': 'Bearer ' + self.api_key,
-                'OpenAI-Organization': self.org
-            },
-            json = cfg
-        ).json()
+        return cfg
+
+    def _read_reply(self, res, start, s):
         if res.get('error') is not None:
-            if 'overloaded' in res.get('error').get('message'):
-                print('ERROR: Server overloaded. Retrying request...')
-                self.run(self)
             raise SyntaxError("error getting chat message: " + res.get('error').get('message'))
+        s.set('prompt_tokens', res.get('usage').get('prompt_tokens'))
+        s.set('completion_tokens', res.get('usage').get('completion_tokens'))
         self._total_tokens = res.get('usage').get('total_tokens')
+        get_usage_ledger().record(self.component,
+            res.get('usage').get('prompt_tokens'),
+            res.get('usage').get('completion_tokens'),
+            time() - start)
         choice = res.get('choices')[0].get('message')
-        self._messages.append(choice)
+        self._append_message(choice)
         return choice.get('content')
 
+    def _read_delta(self, event, role):
+        if event.get('error') is not None:
+            raise SyntaxError("error getting chat message: " + event.get('error').get('message'))
+        delta = event.get('choices')[0].get('delta', { })
+        return delta.get('role', role), delta.get('content')
+
+    def _finish_stream(self, role, parts, prompt_tokens, start, s):
+        message = { 'role': role, 'content': ''.join(parts) }
+        self._append_message(message)
+        # streamed responses carry no usage, so both sides are estimated locally
+        completion_tokens = self._message_token_count(len(self._messages) - 1)
+        self._total_tokens = prompt_tokens + completion_tokens
+        s.set('prompt_tokens', prompt_tokens)
+        s.set('completion_tokens', completion_tokens)
+        get_usage_ledger().record(self.component, prompt_tokens, completion_tokens, time() - start)
+
+# provider limits for a single /v1/embeddings request
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+MAX_EMBEDDING_INPUTS = 2048
+MAX_EMBEDDING_INPUT_TOKENS = 8191
+MAX_EMBEDDING_REQUEST_TOKENS = 300000
+
 class EmbeddingFactory:
     def __init__(self, api_key, org_key):
         self.api_key = api_key
         self.org_key = org_key
+        self.cache = get_embedding_cache()
+        self.component = 'embedding'
+
+    @property
+    def _encoding(self):
+        return get_encoding(EMBEDDING_MODEL)
 
     def get_embedding(self, data):
+        return self.get_embeddings([data])[0]
+
+    async def aget_embedding(self, data):
+        return (await self.aget_embeddings([data]))[0]
+
+    # embeds every item, serving repeats from the cache and sending the rest in as
+    # few requests as the provider limits allow. results keep input order
+    def get_embeddings(self, data_list):
+        embeddings, keys, missing, batches = self._plan_embeddings(data_list)
+        fetched = []
+        for batch in batches:
+            fetched += self._request_embeddings(batch)
+        return self._store_embeddings(embeddings, keys, missing, fetched)
+
+    # same as get_embeddings but the batches are requested concurrently. cache lookups,
+    # tokenizing and cache writes block, so they run on a worker thread
+    async def aget_embeddings(self, data_list):
+        embeddings, keys, missing, batches = await asyncio.to_thread(self._plan_embeddings, data_list)
+        fetched = []
+        for result in await asyncio.gather(*[self._arequest_embeddings(batch) for batch in batches]):
+            fetched += result
+        if len(fetched) == 0:
+            return embeddings
+        return await asyncio.to_thread(self._store_embeddings, embeddings, keys, missing, fetched)
+
+    # looks every input up in the cache and splits the misses into request sized batches
+    def _plan_embeddings(self, data_list):
+        texts = [_normalize_input(data) for data in data_list]
+        keys = [self.cache.key(EMBEDDING_MODEL, t) for t in texts]
+        with span('embedding.cache', component=self.component, inputs=len(keys)) as s:
+            embeddings = [self.cache.get(k) for k in keys]
+            hits = len([e for e in embeddings if e is not None])
+            s.set('hits', hits)
+        for _ in range(hits):
+            get_usage_ledger().record(self.component, cached=True)
+        # an input repeated within one call is only requested once
+        missing = { }
+        for i, e in enumerate(embeddings):
+            if e is None:
+                missing.setdefault(texts[i], []).append(i)
+        if len(missing) == 0:
+            return embeddings, keys, missing, []
+
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for text in missing:
+            tokens = self._encoding.encode(text)
+            if len(tokens) > MAX_EMBEDDING_INPUT_TOKENS:
+                tokens = tokens[:MAX_EMBEDDING_INPUT_TOKENS]
+                text = self._encoding.decode(tokens)
+            if len(batch) == MAX_EMBEDDING_INPUTS or batch_tokens + len(tokens) > MAX_EMBEDDING_REQUEST_TOKENS:
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(text)
+            batch_tokens += len(tokens)
+        if len(batch) > 0:
+            batches.append(batch)
+        return embeddings, keys, missing, batches
+
+    def _store_embeddings(self, embeddings, keys, missing, fetched):
+        for idxs, e in zip(missing.values(), fetched):
+            self.cache.put(keys[idxs[0]], e)
+            for i in idxs:
+                embeddings[i] = e
+        return embeddings
+
+    def _request_embeddings(self, inputs):
         d = {
-            "model": 'text-embedding-ada-002',
-            "input": json.dumps(data)
+            "model": EMBEDDING_MODEL,
+            "input": inputs
         }
-        res = requests.post('https://api.openai.com/v1/embeddings', 
-            headers={
-                'Authorization': 'Bearer ' + self.api_key,
-                'OpenAI-Organization': self.org_key
-            },
-            json=d
-        ).json()
+        start = time()
+        with span('http.embeddings', component=self.component, inputs=len(inputs)) as s:
+            res = get_transport().post('/embeddings', self.api_key, self.org_key, d)
+            return self._read_embeddings(res, start, s)
+
+    async def _arequest_embeddings(self, inputs):
+        d = {
+            "model": EMBEDDING_MODEL,
+            "input": inputs
+        }
+        start = time()
+        with span('http.embeddings', component=self.component, inputs=len(inputs)) as s:
+            res = await get_async_transport().post('/embeddings', self.api_key, self.org_key, d)
+            return self._read_embeddings(res, start, s)
+
+    def _read_embeddings(self, res, start, s):
         if res.get('error') is not None:
-            if 'overloaded' in res.get('error').get('message'):
-                print('ERROR: Server overloaded. Retrying request...')
-                self.get_embedding(self, data)
             raise SyntaxError("Error getting embedding: " + res.get('error').get('message'))
-        return res.get('data')[0].get('embedding')
\ No newline at end of file
+        s.set('prompt_tokens', res.get('usage').get('prompt_tokens'))
+        get_usage_ledger().record(self.component, res.get('usage').get('prompt_tokens'), 0, time() - start)
+        data = sorted(res.get('data'), key=lambda e: e.get('index'))
+        return [e.get('embedding') for e in data]
+
+# strings are embedded as-is rather than json encoded, so equal text always shares a cache entry
+def _normalize_input(data):
+    text = data if isinstance(data, str) else json.dumps(data, sort_keys=True)
+    return unicodedata.normalize('NFC', text).strip()
\ No newline at end of file
@@ -0,0 +1,438 @@
+import threading
+import numpy as np
+from ann import get_ann_config, open_ivf
+from lexical import get_retrieval_config, open_bm25, record_text
+from quantize import get_quantization_config, open_codes
+from store import EmbeddingStore, legacy_files
+from tracing import span, in_context
+
+# rows per block when computing norms so loading never copies the whole mapped segment
+NORM_BLOCK = 65536
+# row and column block sizes for the pairwise similarity pass of duplicates()
+DEDUPE_ROWS = 512
+DEDUPE_COLS = 16384
+# compaction starts once this many rows and this share of all rows are dead
+COMPACT_MIN_DEAD = 1024
+COMPACT_DEAD_RATIO = 0.25
+
+# records are addressed by their store id, which maps to a row of the matrix through the
+# sorted _ids array. dead rows are reclaimed by compaction on a background thread once
+# they pass COMPACT_DEAD_RATIO of the store. with ann enabled, stores past its min_rows
+# are searched through an IVF index instead of scoring every row. text queries can also be
+# answered by a BM25 index over the same rows, which is loaded once it is first needed. with
+# quantization enabled, scans score compressed codes kept in memory and read float32 rows
+# only to re-rank the best candidates
+class VectorIndex:
+    def __init__(self, folder):
+        self.folder = folder
+        self.store = EmbeddingStore(folder)
+        self._lock = threading.RLock()
+        self._compactor = None
+        self.load()
+
+    def __len__(self):
+        return int(self._live.sum())
+
+    def load(self):
+        if len(legacy_files(self.folder)) > 0:
+            print('WARNING: %s contains files in the old format, run src/migrate.py to import them' % self.folder)
+        with self._lock, span('index.load', folder=self.folder) as s:
+            # the matrix is the store's memory map, scoring reads it in place without copying
+            self._vectors = self.store.vectors()
+            self._norms = _norms(self._vectors)
+            self._ids, metadata = self.store.read_log()
+            self._meta = [None] * self.store.rows
+            for row, meta in metadata.items():
+                self._meta[row] = meta
+            self._live = np.array([m is not None for m in self._meta], dtype=bool)
+            s.set('rows', len(self._meta))
+            s.set('bytes_read', self._vectors.nbytes)
+            self.ivf = None
+            self._open_ivf()
+            self.codes = None
+            self._open_codes()
+            self.lexical = None
+            if get_retrieval_config()['mode'] != 'vector':
+                self._lexical()
+
+    def dead_rows(self):
+        return len(self._meta) - len(self)
+
+    def is_live(self, record_id):
+        row = self._row(record_id)
+        return row is not None and bool(self._live[row])
+
+    def vector(self, record_id):
+        return self._vectors[self._row(record_id)]
+
+    # stored vectors of ids as rows of one array, zeros for ids that are no longer stored
+    def vectors(self, ids):
+        with self._lock:
+            vectors = np.zeros((len(ids), self._vectors.shape[1]), dtype=np.float32)
+            for i, record_id in enumerate(ids):
+                row = self._row(record_id)
+                if row is not None:
+                    vectors[i] = self._vectors[row]
+            return vectors
+
+    def items(self):
+        with self._lock:
+            return [dict(m) for m in self._meta if m is not None]
+
+    def add(self, objs):
+        with self._lock:
+            ids = self.store.append(objs)
+            if len(ids) == 0:
+                return ids
+            start = len(self._meta)
+            self._vectors = self.store.vectors()
+            self._norms = np.concatenate([self._norms, _norms(self._vectors[start:])])
+            self._ids = np.concatenate([self._ids, np.array(ids, dtype=np.int64)])
+            for record_id, o in zip(ids, objs):
+                meta = { k: v for k, v in o.items() if k != 'embedding' }
+                meta['id'] = record_id
+                self._meta.append(meta)
+            self._live = np.concatenate([self._live, np.ones(len(ids), dtype=bool)])
+            if self.ivf is not None:
+                self.ivf.add(self._vectors[start:], self._norms[start:])
+            else:
+                self._open_ivf()
+            if self.codes is not None:
+                self.codes.add(self._vectors[start:], self._norms[start:])
+            else:
+                self._open_codes()
+            if self.lexical is not None:
+                self.lexical.add([record_text(m) for m in self._meta[start:]])
+            return ids
+
+    def remove(self, ids):
+        with self._lock:
+            rows = [row for row in self._rows(ids) if self._live[row]]
+            self.store.delete([int(self._ids[row]) for row in rows])
+            for row in rows:
+                self._meta[row] = None
+                self._live[row] = False
+            if self.lexical is not None:
+                self.lexical.remove(rows)
+        self.maybe_compact()
+
+    # stored vectors are append-only, so an update tombstones the old record and returns the new id
+    def update(self, record_id, obj):
+        with self._lock:
+            self.remove([record_id])
+            return self.add([obj])[0]
+
+    # ids to drop so no two live records are more similar than max_sim, newer records win.
+    # passing ids only checks those records against the whole set, which is enough
+    # when everything else was already deduplicated. the ids returned can then include
+    # older records outside ids that a checked record replaces
+    def duplicates(self, max_sim, ids=None):
+        with self._lock, span('dedupe', folder=self.folder) as s:
+            rows = None if ids is None else self._rows(ids)
+            removed = [int(self._ids[row]) for row in self._duplicates(max_sim, rows)]
+            s.set('removed', len(removed))
+            return removed
+
+    def _duplicates(self, max_sim, rows):
+        n = len(self._meta)
+        rows = self._live_rows() if rows is None else np.array([r for r in rows if self._live[r]], dtype=np.int64)
+        rows = np.sort(rows)[::-1]
+        checked = np.zeros(n, dtype=bool)
+        checked[rows] = True
+        removed = np.zeros(n, dtype=bool)
+        for start in range(0, len(rows), DEDUPE_ROWS):
+            block = rows[start:start + DEDUPE_ROWS]
+            q = np.asarray(self._vectors[block]) / self._norms[block][:, None]
+            neighbors = [[] for _ in block]
+            for col in range(0, n, DEDUPE_COLS):
+                sims = (q @ self._vectors[col:col + DEDUPE_COLS].T) / self._norms[col:col + DEDUPE_COLS]
+                hits = (sims > max_sim) & self._live[col:col + DEDUPE_COLS]
+                for b, j in zip(*np.nonzero(hits)):
+                    neighbors[b].append(col + j)
+            for b, i in enumerate(block):
+                # a newer neighbor that is still live wins over this row
+                if any(j > i and not removed[j] for j in neighbors[b]):
+                    removed[i] = True
+                    continue
+                # older neighbors that are checked are decided after this row, the
+                # others are only reached from here so they lose to it now
+                for j in neighbors[b]:
+                    if j < i and not checked[j]:
+                        removed[j] = True
+        return np.flatnonzero(removed)
+
+    # text is the query the embedding was made from, used by the rerank and fusion modes
+    def search(self, q_embed, top_n, exclude=[], exclude_key=None, text=None):
+        mode = 'vector' if text is None else get_retrieval_config()['mode']
+        with self._lock, span('retrieval', folder=self.folder, top_n=top_n, ann=self.ivf is not None, mode=mode) as s:
+            if top_n <= 0:
+                return []
+            if mode == 'rerank':
+                return self._search_rerank(q_embed, text, top_n, exclude, exclude_key, s)
+            if mode == 'fusion':
+                return self._search_fusion(q_embed, text, top_n, exclude, exclude_key, s)
+            # lexical mode only embeds queries the BM25 index found nothing for
+            return self._search(q_embed, top_n, exclude, exclude_key, s)
+
+    # BM25 ranking of the records whose text shares a term with the query, no embedding needed
+    def lexical_search(self, text, top_n, exclude=[], exclude_key=None):
+        with self._lock, span('retrieval.lexical', folder=self.folder, top_n=top_n) as s:
+            if top_n <= 0:
+                return []
+            rows, scores = self._lexical().scores(text)
+            s.set('candidates', len(rows))
+            return self._rank(scores, rows, top_n, exclude, exclude_key)
+
+    def _search(self, q_embed, top_n, exclude, exclude_key, s):
+        n = len(self._meta)
+        if n == 0 or top_n <= 0:
+            return []
+        q = np.asarray(q_embed, dtype=np.float32)
+        q_norm = np.linalg.norm(q)
+        if q_norm == 0:
+            q_norm = 1
+        if self.ivf is not None:
+            return self._search_ivf(q / q_norm, top_n, exclude, exclude_key, s)
+        s.set('candidates', n)
+        scores = self._scan(q / q_norm, None, s)
+        scores[~self._live] = -np.inf
+        return self._rank_scan(q / q_norm, scores, None, top_n, exclude, exclude_key, s)
+
+    # scores the live rows of the nearest lists, probing twice as many lists
+    # whenever filtering leaves fewer than top_n results
+    def _search_ivf(self, q, top_n, exclude, exclude_key, s):
+        nprobe = self.ivf.nprobe
+        while True:
+            rows = self.ivf.candidates(q, nprobe)
+            rows = rows[self._live[rows]]
+            s.set('nprobe', nprobe)
+            s.set('candidates', len(rows))
+            scores = self._scan(q, rows, s)
+            most_similar = self._rank_scan(q, scores, rows, top_n, exclude, exclude_key, s)
+            if len(most_similar) == top_n or nprobe >= self.ivf.nlist:
+                return most_similar
+            nprobe *= 2
+
+    # similarity of the unit query to rows, or to every row, scored on the compressed codes when there are any
+    def _scan(self, q, rows, s):
+        if self.codes is not None:
+            s.set('bytes_read', self.codes.nbytes() if rows is None else self.codes.nbytes() * len(rows) // max(1, len(self.codes)))
+            return self.codes.scores(q, rows)
+        if rows is None:
+            s.set('bytes_read', self._vectors.nbytes)
+            return self._vectors @ q / self._norms
+        s.set('bytes_read', len(rows) * self._vectors.shape[1] * 4)
+        return np.asarray(self._vectors[rows]) @ q / self._norms[rows]
+
+    # scores of compressed codes only pick the best rerank candidates, which are then
+    # ranked by their similarity on the float32 rows
+    def _rank_scan(self, q, scores, rows, top_n, exclude, exclude_key, s):
+        if self.codes is None or self.codes.rerank <= 0 or len(scores) == 0:
+            return self._rank(scores, rows, top_n, exclude, exclude_key)
+        k = min(max(self.codes.rerank, top_n + len(exclude)), len(scores))
+        top = np.sort(np.argpartition(-scores, k - 1)[:k])
+        top = top[scores[top] > -np.inf]
+        candidates = top if rows is None else rows[top]
+        s.set('reranked', len(candidates))
+        exact = np.asarray(self._vectors[candidates]) @ q / self._norms[candidates]
+        return self._rank(exact, candidates, top_n, exclude, exclude_key)
+
+    # the BM25 candidates ranked by vector similarity, topped up from a vector search
+    # when there are fewer than top_n of them
+    def _search_rerank(self, q_embed, text, top_n, exclude, exclude_key, s):
+        candidates = get_retrieval_config()['candidates']
+        rows, scores = self._lexical().scores(text)
+        if len(rows) > candidates:
+            rows = np.sort(rows[np.argpartition(-scores, candidates - 1)[:candidates]])
+        s.set('candidates', len(rows))
+        most_similar = self._rank(self._cosine(q_embed, rows), rows, top_n, exclude, exclude_key)
+        if len(most_similar) == top_n:
+            return most_similar
+        found = set(m['id'] for _, m in most_similar)
+        for score, meta in self._search(q_embed, top_n + len(found), exclude, exclude_key, s):
+            if len(most_similar) == top_n:
+                break
+            if meta['id'] not in found:
+                most_similar.append((score, meta))
+        return most_similar
+
+    # scores the vector candidates and the BM25 matches by both, every row is a vector
+    # candidate unless the IVF index is in use
+    def _search_fusion(self, q_embed, text, top_n, exclude, exclude_key, s):
+        weight = get_retrieval_config()['weight']
+        lexical_rows, lexical_scores = self._lexical().scores(text)
+        if len(lexical_rows) > 0:
+            lexical_scores = lexical_scores / lexical_scores.max()
+        if self.ivf is None:
+            rows = None
+            bm25 = np.zeros(len(self._meta))
+            bm25[lexical_rows] = lexical_scores
+        else:
+            q = np.asarray(q_embed, dtype=np.float32)
+            rows = np.union1d(self.ivf.candidates(q / (np.linalg.norm(q) or 1)), lexical_rows)
+            bm25 = np.zeros(len(rows))
+            bm25[np.searchsorted(rows, lexical_rows)] = lexical_scores
+        s.set('candidates', len(self._meta) if rows is None else len(rows))
+        s.set('lexical_candidates', len(lexical_rows))
+        scores = (1 - weight) * self._cosine(q_embed, rows) + weight * bm25
+        return self._rank(scores, rows, top_n, exclude, exclude_key)
+
+    # cosine similarity of the query to rows, or to every row, with dead rows at -inf
+    def _cosine(self, q_embed, rows=None):
+        q = np.asarray(q_embed, dtype=np.float32)
+        q_norm = np.linalg.norm(q)
+        if q_norm == 0:
+            q_norm = 1
+        if rows is None:
+            scores = self._vectors @ q / (self._norms * q_norm)
+            scores[~self._live] = -np.inf
+            return scores
+        scores = np.asarray(self._vectors[rows]) @ q / (self._norms[rows] * q_norm)
+        scores[~self._live[rows]] = -np.inf
+        return scores
+
+    # best top_n of scores, rows maps each score to its row when only some rows were scored
+    def _rank(self, scores, rows, top_n, exclude, exclude_key):
+        n = len(scores)
+        if n == 0:
+            return []
+        # over-fetch by the number of excluded values so filtering rarely needs a second pass
+        k = top_n if exclude_key is None else top_n + len(exclude)
+        while True:
+            k = min(k, n)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            most_similar = []
+            for i in top:
+                if scores[i] == -np.inf:
+                    return most_similar
+                obj = self._meta[i if rows is None else rows[i]]
+                if exclude_key is not None and obj[exclude_key] in exclude:
+                    continue
+                most_similar.append((float(scores[i]), dict(obj)))
+                if len(most_similar) == top_n:
+                    return most_similar
+            if k == n:
+                return most_similar
+            k *= 2
+
+    # starts a background compaction once enough rows are dead, returns whether one was started
+    def maybe_compact(self):
+        with self._lock:
+            dead = self.dead_rows()
+            if dead < COMPACT_MIN_DEAD or dead < COMPACT_DEAD_RATIO * len(self._meta):
+                return False
+            if self._compactor is not None and self._compactor.is_alive():
+                return False
+            self._compactor = threading.Thread(target=in_context(self.compact), daemon=True)
+            self._compactor.start()
+            return True
+
+    # rewrites the store without dead rows. rows that were live when it started are copied
+    # without holding the lock, rows added or removed meanwhile are reconciled under it
+    def compact(self):
+        with span('index.compact', folder=self.folder) as s:
+            with self._lock:
+                n = len(self._meta)
+                vectors = self._vectors
+                keep = np.flatnonzero(self._live)
+                compaction = self.store.compaction()
+            try:
+                for start in range(0, len(keep), NORM_BLOCK):
+                    compaction.write(vectors[keep[start:start + NORM_BLOCK]])
+                with self._lock:
+                    tail = np.flatnonzero(self._live[n:]) + n
+                    compaction.write(self._vectors[tail])
+                    order = np.concatenate([keep, tail])
+                    meta = { row: self._meta[old] for row, old in enumerate(order) if self._meta[old] is not None }
+                    compaction.commit(self._ids[order], meta)
+                    s.set('rows_before', len(self._meta))
+                    s.set('rows_after', len(order))
+                    self._vectors = self.store.vectors()
+                    self._norms = self._norms[order]
+                    self._ids = self._ids[order]
+                    self._meta = [self._meta[old] for old in order]
+                    self._live = self._live[order]
+                    if self.ivf is not None:
+                        self.ivf.reorder(order, self.store.generation)
+                        self.ivf.save()
+                    if self.codes is not None:
+                        self.codes.reorder(order, self.store.generation)
+                        self.codes.save()
+                    if self.lexical is not None:
+                        self.lexical.reorder(order, self.store.generation)
+                        self.lexical.save()
+            except BaseException:
+                compaction.abort()
+                raise
+
+    # waits for a running compaction and saves the codes and BM25 index, the index should not be used afterwards
+    def close(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self._lock:
+            if self.codes is not None and self.codes.dirty:
+                self.codes.save()
+            if self.lexical is not None and self.lexical.dirty:
+                self.lexical.save()
+
+    def _row(self, record_id):
+        row = int(np.searchsorted(self._ids, record_id))
+        if row < len(self._ids) and self._ids[row] == record_id:
+            return row
+        return None
+
+    def _rows(self, ids):
+        return [row for row in (self._row(record_id) for record_id in ids) if row is not None]
+
+    def _live_rows(self):
+        return np.flatnonzero(self._live)
+
+    def _lexical(self):
+        if self.lexical is None:
+            self.lexical = open_bm25(self.folder, self._meta, self.store.generation)
+        return self.lexical
+
+    def _open_codes(self):
+        config = get_quantization_config()
+        if config is not None and self.store.dim is not None:
+            self.codes = open_codes(self.folder, self._vectors, self._norms, self._live, self.store.generation, config)
+
+    def _open_ivf(self):
+        config = get_ann_config()
+        if config is not None and len(self) >= config['min_rows']:
+            self.ivf = open_ivf(self.folder, self._vectors, self._norms, self._live, self.store.generation, config)
+
+def _norms(vectors):
+    norms = np.zeros(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), NORM_BLOCK):
+        block = np.asarray(vectors[start:start + NORM_BLOCK])
+        norms[start:start + len(block)] = np.sqrt(np.einsum('ij,ij->i', block, block))
+    norms[norms == 0] = 1
+    return norms
+
+_indexes = { }
+_indexes_lock = threading.Lock()
+
+# indexes are loaded once per folder and shared for the life of the process
+def get_index(folder):
+    with _indexes_lock:
+        if folder not in _indexes:
+            _indexes[folder] = VectorIndex(folder)
+        return _indexes[folder]
+
+# unloads one folder's index, it is read from disk again on next use
+def drop_index(folder):
+    with _indexes_lock:
+        index = _indexes.pop(folder, None)
+    if index is not None:
+        index.close()
+
+# drops every loaded index, e.g. after changing the working directory
+def clear_indexes():
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+        _indexes.clear()
+    for index in indexes:
+        index.close()
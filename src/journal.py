@@ -0,0 +1,150 @@
+import json
+import os
+import queue
+import re
+import threading
+from tracing import span
+
+SEGMENT = re.compile(r'^journal_(\d+)\.jsonl$')
+
+# write-ahead log of records that are not stored anywhere else yet. append() only queues a
+# record, a writer thread writes everything queued so far and fsyncs once per batch. rotate()
+# seals the current segment so its records can be stored and the segment discarded, segments
+# left over from an earlier run are read back with recover(). the first write that fails stops
+# the writer from writing anything else, and every later call raises that error
+class Journal:
+    def __init__(self, folder):
+        self.folder = folder
+        self.records = 0
+        self.commits = 0
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        segments = sorted((int(m.group(1)), f) for f in os.listdir(folder) for m in [SEGMENT.match(f)] if m is not None)
+        self._recovered = [os.path.join(folder, f) for _, f in segments]
+        self._seq = segments[-1][0] + 1 if len(segments) > 0 else 1
+        # opened on the first record so idle sessions leave no empty segments behind
+        self._file = None
+        self._error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # records of the segments an earlier run left behind, a torn last line is dropped
+    def recover(self):
+        records = []
+        for path in self._recovered:
+            with open(path, 'r', encoding='utf-8') as infile:
+                for line in infile:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+        return records
+
+    def append(self, rec):
+        self._check()
+        self._queue.put(('append', rec))
+
+    # returns once every record appended before the call is on disk
+    def flush(self):
+        self._call('flush')
+
+    # seals the current segment and returns the paths of every segment not handed out yet
+    def rotate(self):
+        return self._call('rotate')
+
+    def discard(self, segments):
+        for path in segments:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        if self._thread.is_alive():
+            try:
+                self._call('close')
+            finally:
+                self._thread.join()
+
+    # the writer answers every call, after a failed write it only releases the caller
+    def _call(self, op):
+        done = threading.Event()
+        result = []
+        self._queue.put((op, (done, result)))
+        done.wait()
+        self._check()
+        return result[0] if len(result) > 0 else None
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            pending = 0
+            for op, arg in batch:
+                if op == 'append':
+                    self._guard(self._write, arg)
+                    pending += 1
+                    continue
+                # control messages see every record queued before them committed
+                self._guard(self._commit, pending)
+                pending = 0
+                done, result = arg
+                if op == 'rotate':
+                    self._guard(lambda: result.append(self._seal()))
+                elif op == 'close':
+                    try:
+                        self._close_file()
+                    except OSError:
+                        pass
+                    done.set()
+                    return
+                done.set()
+            self._guard(self._commit, pending)
+
+    # keeps the first error and skips every write after it
+    def _guard(self, fn, *args):
+        if self._error is not None:
+            return
+        try:
+            fn(*args)
+        except Exception as e:
+            print('ERROR: writing the journal failed, later turns are not journaled: %s' % e)
+            self._error = e
+
+    def _write(self, rec):
+        if self._file is None:
+            self._file = open(self._path(), 'a', encoding='utf-8')
+        self._file.write(json.dumps(rec, separators=(',', ':')) + '\n')
+
+    def _commit(self, pending):
+        if pending == 0:
+            return
+        with span('journal.commit', records=pending):
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self.records += pending
+        self.commits += 1
+
+    def _seal(self):
+        sealed = self._recovered
+        self._recovered = []
+        if self._file is not None:
+            self._close_file()
+            sealed.append(self._path())
+            self._seq += 1
+        return sealed
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _path(self):
+        return os.path.join(self.folder, 'journal_%d.jsonl' % self._seq)
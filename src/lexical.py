@@ -0,0 +1,183 @@
+import os
+import re
+import numpy as np
+from tracing import span
+
+TOKEN = re.compile(r'\w+')
+# fields of memory and concept records that are indexed
+TEXT_FIELDS = ['salient_points', 'data']
+K1 = 1.2
+B = 0.75
+# terms in more than this share of the records barely change the ranking but have the longest
+# postings, so they are not scored. a query of only such terms matches nothing and is left to
+# vector search
+COMMON_TERM_RATIO = 0.5
+MODES = ['vector', 'lexical', 'rerank', 'fusion']
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+def record_text(meta):
+    if meta is None:
+        return None
+    return ' '.join(meta[f] for f in TEXT_FIELDS if isinstance(meta.get(f), str))
+
+# BM25 inverted index over the rows of a VectorIndex. postings are appended as rows are
+# added and removed rows only lose their length, so they drop out of scoring and document
+# frequencies without touching the postings. saved next to the store, rows appended or
+# removed after the save are caught up when it is loaded
+class BM25:
+    def __init__(self, path):
+        self.path = path
+        self.generation = 0
+        self.docs = 0
+        self.total_length = 0
+        self.dirty = False
+        # tokens of every row, 0 for rows that are dead or have no text
+        self._lengths = np.zeros(0, dtype=np.int32)
+        # term -> (rows, term frequencies), in row order
+        self._postings = { }
+        # arrays of the postings of queried terms, dropped when a term gets new postings
+        self._arrays = { }
+
+    def __len__(self):
+        return len(self._lengths)
+
+    # indexes rows appended to the store, texts are the new rows only with None for dead rows
+    def add(self, texts):
+        start = len(self._lengths)
+        lengths = np.zeros(len(texts), dtype=np.int32)
+        for i, text in enumerate(texts):
+            if text is None:
+                continue
+            counts = { }
+            for term in tokenize(text):
+                counts[term] = counts.get(term, 0) + 1
+            for term, tf in counts.items():
+                rows, tfs = self._postings.setdefault(term, ([], []))
+                rows.append(start + i)
+                tfs.append(tf)
+                self._arrays.pop(term, None)
+            lengths[i] = sum(counts.values())
+        self._lengths = np.concatenate([self._lengths, lengths])
+        self.docs += int(np.count_nonzero(lengths))
+        self.total_length += int(lengths.sum())
+        self.dirty = True
+
+    def remove(self, rows):
+        for row in rows:
+            if self._lengths[row] > 0:
+                self.docs -= 1
+                self.total_length -= int(self._lengths[row])
+                self._lengths[row] = 0
+                self.dirty = True
+
+    # returns the sorted rows that contain any term of the query and their BM25 scores
+    def scores(self, text):
+        matched = []
+        scored = []
+        if self.docs > 0:
+            avgdl = self.total_length / self.docs
+            terms = [t for t in set(tokenize(text)) if t in self._postings and len(self._postings[t][0]) <= COMMON_TERM_RATIO * self.docs]
+            for term in terms:
+                rows, tfs = self._array(term)
+                lengths = self._lengths[rows]
+                live = lengths > 0
+                rows, tfs, lengths = rows[live], tfs[live], lengths[live]
+                if len(rows) == 0:
+                    continue
+                idf = np.log(1 + (self.docs - len(rows) + 0.5) / (len(rows) + 0.5))
+                matched.append(rows)
+                scored.append(idf * tfs * (K1 + 1) / (tfs + K1 * (1 - B + B * lengths / avgdl)))
+        if len(matched) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        rows, inverse = np.unique(np.concatenate(matched), return_inverse=True)
+        return rows, np.bincount(inverse, weights=np.concatenate(scored))
+
+    # follows a compaction of the store, order holds the old row of every new row
+    def reorder(self, order, generation):
+        new_rows = np.full(len(self._lengths), -1, dtype=np.int64)
+        new_rows[order] = np.arange(len(order))
+        for term in list(self._postings):
+            rows, tfs = self._array(term)
+            rows = new_rows[rows]
+            kept = rows >= 0
+            if not kept.any():
+                del self._postings[term]
+                continue
+            self._postings[term] = (rows[kept].tolist(), tfs[kept].tolist())
+        self._arrays.clear()
+        self._lengths = self._lengths[order]
+        self.generation = generation
+        self.dirty = True
+
+    def save(self):
+        terms = list(self._postings)
+        counts = [len(self._postings[t][0]) for t in terms]
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as outfile:
+            np.savez(outfile,
+                terms=np.array(terms, dtype=str),
+                offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                rows=np.array([r for t in terms for r in self._postings[t][0]], dtype=np.int64),
+                tfs=np.array([tf for t in terms for tf in self._postings[t][1]], dtype=np.int32),
+                lengths=self._lengths,
+                generation=self.generation)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def _array(self, term):
+        if term not in self._arrays:
+            rows, tfs = self._postings[term]
+            self._arrays[term] = (np.array(rows, dtype=np.int64), np.array(tfs, dtype=np.float64))
+        return self._arrays[term]
+
+# loads the saved index of a store or builds a new one, then indexes any rows it does not
+# cover and drops rows that were removed since it was saved
+def open_bm25(folder, meta, generation):
+    path = folder + '/bm25.npz'
+    index = BM25(path)
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            # postings of another generation point at rows that have moved
+            if int(saved['generation']) == generation and len(saved['lengths']) <= len(meta):
+                offsets = saved['offsets']
+                rows = saved['rows'].tolist()
+                tfs = saved['tfs'].tolist()
+                for i, term in enumerate(saved['terms'].tolist()):
+                    index._postings[term] = (rows[offsets[i]:offsets[i + 1]], tfs[offsets[i]:offsets[i + 1]])
+                index._lengths = saved['lengths'].astype(np.int32)
+                index.docs = int(np.count_nonzero(index._lengths))
+                index.total_length = int(index._lengths.sum())
+    index.generation = generation
+    start = len(index)
+    if start < len(meta):
+        with span('bm25.index', rows=len(meta) - start):
+            index.add([record_text(m) for m in meta[start:]])
+    index.remove([row for row in np.flatnonzero(index._lengths).tolist() if meta[row] is None])
+    if index.dirty:
+        index.save()
+    return index
+
+_config = {
+    'mode': 'vector',
+    'candidates': 200,
+    'weight': 0.3
+}
+
+# how text queries are answered. vector embeds every query, lexical answers from the BM25
+# index and only embeds queries it finds nothing for, rerank scores the best candidates
+# of the BM25 index by vector similarity and fusion ranks by (1 - weight) * cosine
+# similarity + weight * BM25 score scaled to the best match
+def configure_retrieval(mode='vector', candidates=200, weight=0.3):
+    if mode not in MODES:
+        raise ValueError('retrieval mode must be one of ' + ', '.join(MODES))
+    _config.update({
+        'mode': mode,
+        'candidates': candidates,
+        'weight': weight
+    })
+    return _config
+
+def get_retrieval_config():
+    return _config
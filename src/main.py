@@ -1,17 +1,67 @@
 from andy import Andy
 from util import open_file
+from usage import get_usage_ledger
+from tracing import get_tracer
+from time import time
+import argparse
 import signal
 
+parser = argparse.ArgumentParser(description='Chat with Andy in the terminal, or host many sessions over HTTP and WebSockets')
+parser.add_argument('--serve', action='store_true', help='run the multi-session server instead of the terminal chat')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8080)
+parser.add_argument('--root', default='sessions', help='folder holding each session\'s chat logs, memories and concepts')
+parser.add_argument('--idle-timeout', type=float, default=900, help='seconds before an idle session is saved and unloaded')
+parser.add_argument('--max-sessions', type=int, default=64)
+parser.add_argument('--ann', action='store_true', help='search stores of 100000 or more vectors through an approximate IVF index')
+parser.add_argument('--ann-nprobe', type=int, default=16, help='lists each approximate search scores, higher is slower and more accurate')
+parser.add_argument('--quantize', choices=['float16', 'int8', 'pq'], default=None, help='score memories and concepts on compressed copies of their vectors')
+parser.add_argument('--quantize-rerank', type=int, default=100, help='best quantized candidates re-scored on the float32 vectors, 0 to turn off')
+parser.add_argument('--retrieval', choices=['vector', 'lexical', 'rerank', 'fusion'], default='vector', help='how memories and concepts are retrieved, see configure_retrieval in src/lexical.py')
+parser.add_argument('--context-budget', type=int, default=800, help='tokens retrieved memories and concepts may add to the system prompt')
+parser.add_argument('--completion-cache', action='store_true', help='reuse the text of temperature 0 completions, kept in cache/completions.db')
+parser.add_argument('--completion-cache-size', type=int, default=100000, help='completions the cache keeps on disk')
+args = parser.parse_args()
+
+if args.ann:
+    from ann import enable_ann
+    enable_ann(nprobe=args.ann_nprobe)
+if args.quantize is not None:
+    from quantize import enable_quantization
+    enable_quantization(args.quantize, rerank=args.quantize_rerank)
+if args.retrieval != 'vector':
+    from lexical import configure_retrieval
+    configure_retrieval(args.retrieval)
+if args.completion_cache:
+    from cache import enable_completion_cache
+    enable_completion_cache(max_disk_entries=args.completion_cache_size)
+
 convo_length = 30
 api_key = open_file('key_openai.txt').split('\n')[0]
 org_key = open_file('key_org.txt').split('\n')[0]
-muse = Andy(api_key, org_key)
+
+def report_usage():
+    ledger = get_usage_ledger()
+    print(ledger.report())
+    ledger.dump('usage/usage_%s.json' % time())
+    get_tracer().close()
+
+if args.serve:
+    from server import serve
+    # sessions are saved when the server shuts down
+    serve(api_key, org_key, args.host, args.port, args.root, args.idle_timeout, args.max_sessions, context_budget=args.context_budget)
+    report_usage()
+    exit(0)
+
+muse = Andy(api_key, org_key, context_budget=args.context_budget)
 
 # save whatever is in the chat log when key interrupt
 def keyboardInterruptHandler(_, __):
     if len(muse._messages) > 2:
         print("Conversation saved")
     muse.save_messages()
+    muse.close()
+    report_usage()
     exit(0)
 signal.signal(signal.SIGINT, keyboardInterruptHandler)
 
@@ -21,17 +71,28 @@ while True:
         muse.reset()
         continue
     if user_input == 'LOAD':
-        msg = muse.load()
+        try:
+            msg = muse.load()
+        except FileNotFoundError as e:
+            print('Error: ' + str(e))
+            continue
         print('Context:\n ' + msg)
         continue
     if user_input == 'CLEAN':
         msg = muse.clean_memories()
         continue
     if user_input == 'WRITE':
-        res = muse.write_document()
         print('--------------------')
-        print(res)
+        path = muse.write_document()
+        print('--------------------')
+        print('Document written to ' + path)
         continue
     print('Sending message...')
-    msg_res = muse.send_chat(user_input)
-    print('\n\nMUSE:\n%s' % msg_res + '\n\n')
+    started = [False]
+    def print_token(token):
+        if not started[0]:
+            print('\n\nMUSE:')
+            started[0] = True
+        print(token, end='', flush=True)
+    muse.send_chat(user_input, on_token=print_token)
+    print('\n\n')
@@ -0,0 +1,34 @@
+import json
+import os
+from store import EmbeddingStore, legacy_files
+from util import open_file
+
+# one-shot import of the old embeddings/*.jsonl and concepts/*.json layout,
+# the old files are moved to <folder>_legacy once their records are stored
+def migrate_folder(folder):
+    files = legacy_files(folder)
+    if len(files) == 0:
+        return 0
+    store = EmbeddingStore(folder)
+    count = 0
+    for f in sorted(files):
+        objs = [ ]
+        for line in open_file(folder + '/' + f).split('\n'):
+            if len(line) == 0:
+                continue
+            obj = json.loads(line)
+            obj.pop('file_name', None)
+            objs.append(obj)
+        store.append(objs)
+        count += len(objs)
+
+    backup = folder + '_legacy'
+    if not os.path.exists(backup):
+        os.makedirs(backup)
+    for f in files:
+        os.rename(folder + '/' + f, backup + '/' + f)
+    return count
+
+if __name__ == '__main__':
+    for folder in ['embeddings', 'concepts']:
+        print('Migrated %d records from %s' % (migrate_folder(folder), folder))
@@ -0,0 +1,267 @@
+import os
+import numpy as np
+from tracing import span
+
+MODES = ['float16', 'int8', 'pq']
+# rows per block when encoding
+BLOCK = 16384
+# rows per block when codes are converted to float32 for scoring, small enough to stay in cache
+SCORE_BLOCK = 1024
+# product quantization centroids per subspace, one byte per code
+PQ_CENTROIDS = 256
+# rows a product quantizer needs before it is trained, smaller stores are searched exactly
+PQ_MIN_ROWS = 1024
+
+# unit vectors stored as float16, scored in float32 a block at a time. numpy converts float16
+# without simd on most cpus, so this halves memory but scans slower than float32
+class Float16Codes:
+    def __init__(self, path, dim):
+        self.path = path
+        self.mode = 'float16'
+        self.generation = 0
+        self.dirty = False
+        self.codes = np.zeros((0, dim), dtype=np.float16)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def add(self, vectors, norms):
+        blocks = [self.codes]
+        for start in range(0, len(vectors), BLOCK):
+            blocks.append((np.asarray(vectors[start:start + BLOCK]) / norms[start:start + BLOCK][:, None]).astype(np.float16))
+        self.codes = np.concatenate(blocks)
+        self.dirty = True
+
+    # cosine similarity of the unit query to rows, or to every row
+    def scores(self, q, rows=None):
+        codes = self.codes if rows is None else self.codes[rows]
+        scores = np.zeros(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), SCORE_BLOCK):
+            scores[start:start + SCORE_BLOCK] = codes[start:start + SCORE_BLOCK].astype(np.float32) @ q
+        return scores
+
+    def reorder(self, order, generation):
+        self.codes = self.codes[order]
+        self.generation = generation
+        self.dirty = True
+
+    def save(self):
+        _save(self.path, mode=self.mode, codes=self.codes, generation=self.generation)
+        self.dirty = False
+
+    def load(self, saved):
+        self.codes = saved['codes']
+
+# unit vectors scaled so their largest component is 127 and rounded to int8, with the scale kept per row
+class Int8Codes:
+    def __init__(self, path, dim):
+        self.path = path
+        self.mode = 'int8'
+        self.generation = 0
+        self.dirty = False
+        self.codes = np.zeros((0, dim), dtype=np.int8)
+        self.scales = np.zeros(0, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def add(self, vectors, norms):
+        blocks = [self.codes]
+        scales = [self.scales]
+        for start in range(0, len(vectors), BLOCK):
+            unit = np.asarray(vectors[start:start + BLOCK]) / norms[start:start + BLOCK][:, None]
+            scale = np.abs(unit).max(axis=1) / 127
+            scale[scale == 0] = 1
+            blocks.append(np.rint(unit / scale[:, None]).astype(np.int8))
+            scales.append(scale.astype(np.float32))
+        self.codes = np.concatenate(blocks)
+        self.scales = np.concatenate(scales)
+        self.dirty = True
+
+    def scores(self, q, rows=None):
+        codes = self.codes if rows is None else self.codes[rows]
+        scales = self.scales if rows is None else self.scales[rows]
+        scores = np.zeros(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), SCORE_BLOCK):
+            scores[start:start + SCORE_BLOCK] = codes[start:start + SCORE_BLOCK].astype(np.float32) @ q
+        return scores * scales
+
+    def reorder(self, order, generation):
+        self.codes = self.codes[order]
+        self.scales = self.scales[order]
+        self.generation = generation
+        self.dirty = True
+
+    def save(self):
+        _save(self.path, mode=self.mode, codes=self.codes, scales=self.scales, generation=self.generation)
+        self.dirty = False
+
+    def load(self, saved):
+        self.codes = saved['codes']
+        self.scales = saved['scales']
+
+# product quantization: unit vectors are split into subspaces and every subspace is stored as
+# the byte index of its nearest centroid. a query is scored against each subspace's centroids
+# once and rows are scored by summing table lookups. codes are kept one subspace per row of
+# the array so each lookup reads contiguous memory
+class PQCodes:
+    def __init__(self, path, codebook):
+        self.path = path
+        self.mode = 'pq'
+        self.generation = 0
+        self.dirty = False
+        # subspaces x centroids x subspace dimensions
+        self.codebook = codebook
+        self.codes = np.zeros((len(codebook), 0), dtype=np.uint8)
+
+    def __len__(self):
+        return self.codes.shape[1]
+
+    def nbytes(self):
+        return self.codes.nbytes + self.codebook.nbytes
+
+    def add(self, vectors, norms):
+        blocks = [self.codes]
+        for start in range(0, len(vectors), BLOCK):
+            unit = np.asarray(vectors[start:start + BLOCK]) / norms[start:start + BLOCK][:, None]
+            blocks.append(_nearest_centroids(_subspaces(unit, len(self.codebook)), self.codebook).astype(np.uint8))
+        self.codes = np.concatenate(blocks, axis=1)
+        self.dirty = True
+
+    def scores(self, q, rows=None):
+        table = np.einsum('md,mkd->mk', q.reshape(len(self.codebook), -1), self.codebook)
+        codes = self.codes if rows is None else self.codes[:, rows]
+        scores = np.zeros(codes.shape[1], dtype=np.float32)
+        for m in range(len(codes)):
+            scores += table[m][codes[m]]
+        return scores
+
+    def reorder(self, order, generation):
+        self.codes = self.codes[:, order]
+        self.generation = generation
+        self.dirty = True
+
+    def save(self):
+        _save(self.path, mode=self.mode, codes=self.codes, codebook=self.codebook, generation=self.generation)
+        self.dirty = False
+
+    def load(self, saved):
+        self.codes = saved['codes']
+
+# loads the saved codes of a store or encodes them, then encodes any rows they do not cover.
+# returns None while a product quantizer has too few rows to train on
+def open_codes(folder, vectors, norms, live, generation, config):
+    path = folder + '/codes.npz'
+    codes = None
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            if str(saved['mode']) == config['mode']:
+                if config['mode'] == 'pq':
+                    codes = PQCodes(path, saved['codebook'])
+                else:
+                    codes = _codes(config['mode'], path, vectors.shape[1])
+                # rows of another generation have moved, a product quantizer keeps its codebook
+                if int(saved['generation']) == generation and saved['codes'].shape[-1 if config['mode'] == 'pq' else 0] <= len(vectors):
+                    codes.load(saved)
+    if codes is None:
+        if config['mode'] == 'pq':
+            if int(live.sum()) < PQ_MIN_ROWS:
+                return None
+            codes = PQCodes(path, train_pq(vectors, norms, live, config))
+        else:
+            codes = _codes(config['mode'], path, vectors.shape[1])
+    codes.generation = generation
+    codes.rerank = config['rerank']
+    start = len(codes)
+    if start < len(vectors):
+        with span('codes.encode', mode=config['mode'], rows=len(vectors) - start):
+            codes.add(vectors[start:], norms[start:])
+        codes.save()
+    return codes
+
+# k-means in every subspace at once on a sample of the live rows
+def train_pq(vectors, norms, live, config):
+    rows = np.flatnonzero(live)
+    dim = vectors.shape[1]
+    subspaces = config['subspaces'] or _default_subspaces(dim)
+    if dim % subspaces != 0:
+        raise ValueError('%d dimensional vectors cannot be split into %d subspaces' % (dim, subspaces))
+    with span('pq.train', rows=len(rows), subspaces=subspaces):
+        rng = np.random.default_rng(config['seed'])
+        if len(rows) > config['train_sample']:
+            rows = np.sort(rng.choice(rows, config['train_sample'], replace=False))
+        sample = _subspaces(np.asarray(vectors[rows]) / norms[rows][:, None], subspaces)
+        k = min(PQ_CENTROIDS, sample.shape[1])
+        codebook = sample[:, rng.choice(sample.shape[1], k, replace=False)].copy()
+        index = np.arange(subspaces)[:, None] * k
+        for _ in range(config['iterations']):
+            flat = (_nearest_centroids(sample, codebook) + index).ravel()
+            counts = np.bincount(flat, minlength=subspaces * k).reshape(subspaces, k)
+            sums = np.stack([np.bincount(flat, weights=sample[:, :, j].ravel(), minlength=subspaces * k)
+                for j in range(sample.shape[2])], axis=-1).reshape(subspaces, k, -1)
+            # empty centroids keep their place
+            filled = counts > 0
+            codebook[filled] = (sums[filled] / counts[filled][:, None]).astype(np.float32)
+        return codebook
+
+def _codes(mode, path, dim):
+    if mode == 'float16':
+        return Float16Codes(path, dim)
+    return Int8Codes(path, dim)
+
+# subspaces x rows x subspace dimensions
+def _subspaces(unit, subspaces):
+    return np.ascontiguousarray(unit.reshape(len(unit), subspaces, -1).transpose(1, 0, 2), dtype=np.float32)
+
+# index of the nearest centroid of every row in every subspace, as subspaces x rows
+def _nearest_centroids(x, codebook):
+    nearest = np.zeros(x.shape[:2], dtype=np.int64)
+    c_norms = np.einsum('mkd,mkd->mk', codebook, codebook)[:, None, :]
+    for start in range(0, x.shape[1], 1024):
+        block = x[:, start:start + 1024]
+        dist = c_norms - 2 * np.matmul(block, codebook.transpose(0, 2, 1))
+        nearest[:, start:start + 1024] = np.argmin(dist, axis=2)
+    return nearest
+
+# subspaces of 8 dimensions, or the largest split that divides dim evenly
+def _default_subspaces(dim):
+    return max(m for m in range(1, max(1, dim // 8) + 1) if dim % m == 0)
+
+def _save(path, **arrays):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as outfile:
+        np.savez(outfile, **arrays)
+    os.replace(tmp, path)
+
+_config = None
+
+# stores are scored on compressed copies of their vectors: float16, int8 with a scale per
+# vector or product quantization with subspaces codes per vector (dim / 8 by default). the
+# best rerank candidates are then scored again on the float32 rows, 0 turns that off
+def enable_quantization(mode='int8', rerank=100, subspaces=None, train_sample=16384, iterations=10, seed=0):
+    global _config
+    if mode not in MODES:
+        raise ValueError('quantization mode must be one of ' + ', '.join(MODES))
+    _config = {
+        'mode': mode,
+        'rerank': rerank,
+        'subspaces': subspaces,
+        'train_sample': train_sample,
+        'iterations': iterations,
+        'seed': seed
+    }
+    return _config
+
+def disable_quantization():
+    global _config
+    _config = None
+
+# None unless enable_quantization() was called
+def get_quantization_config():
+    return _config
@@ -0,0 +1,282 @@
+import asyncio
+import contextlib
+import os
+import re
+from time import time
+import aiohttp
+import requests
+from aiohttp import web, WSMsgType
+from andy import Andy
+from tracing import in_context
+from transport import get_async_transport
+
+SESSION_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+COMMANDS = ['RESET', 'LOAD', 'CLEAN', 'WRITE']
+# api errors, and api calls that could not be made after every retry. chat turns run on
+# aiohttp, commands run on the requests transport
+API_ERRORS = (SyntaxError, aiohttp.ClientError, asyncio.TimeoutError, requests.RequestException)
+
+class Session:
+    def __init__(self, session_id, andy):
+        self.id = session_id
+        self.andy = andy
+        # one request at a time per conversation, different sessions run concurrently
+        self.lock = asyncio.Lock()
+        self.last_used = time()
+
+# hosts many conversations in one process. prompts, encoders, the embedding cache and the
+# api connection pool are shared, each session keeps its chat logs, memories and concepts
+# under root/<session id>. sessions idle for idle_timeout seconds, or the least recently
+# used ones past max_sessions, are saved and unloaded. a session in use by a request is
+# never unloaded for being idle or over the limit
+class SessionManager:
+    def __init__(self, api_key, org_key, root='sessions', idle_timeout=900, max_sessions=64, **andy_options):
+        self.api_key = api_key
+        self.org_key = org_key
+        self.root = root
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.andy_options = andy_options
+        self.evicted = 0
+        self._sessions = { }
+        self._closing = { }
+        # session id -> requests using it
+        self._users = { }
+
+    async def get(self, session_id):
+        check_session_id(session_id)
+        # a session that is still being saved is finished before it is opened again
+        if session_id in self._closing:
+            await self._closing[session_id]
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = Session(session_id, Andy(self.api_key, self.org_key, root=os.path.join(self.root, session_id), **self.andy_options))
+            self._sessions[session_id] = session
+            await self._evict_over_limit()
+        session.last_used = time()
+        return session
+
+    # opens a session and keeps it from being evicted until the block ends
+    @contextlib.asynccontextmanager
+    async def use(self, session_id):
+        check_session_id(session_id)
+        self._users[session_id] = self._users.get(session_id, 0) + 1
+        try:
+            yield await self.get(session_id)
+        finally:
+            self._users[session_id] -= 1
+            if self._users[session_id] == 0:
+                del self._users[session_id]
+
+    # holds the lock of the session registered under session.id and yields that session.
+    # one that was evicted while waiting for the lock is closed, so it is opened again
+    @contextlib.asynccontextmanager
+    async def hold(self, session):
+        while True:
+            await session.lock.acquire()
+            if self._sessions.get(session.id) is session:
+                break
+            session.lock.release()
+            session = await self.get(session.id)
+        try:
+            session.last_used = time()
+            yield session
+        finally:
+            session.last_used = time()
+            session.lock.release()
+
+    # runs a blocking Andy method, such as Andy.reset, off the event loop while holding the session
+    async def run(self, session, fn, *args):
+        async with self.hold(session) as session:
+            return await asyncio.get_running_loop().run_in_executor(None, in_context(fn), session.andy, *args)
+
+    async def evict(self, session_id):
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return
+        task = asyncio.ensure_future(self._close(session))
+        self._closing[session_id] = task
+        try:
+            await task
+        finally:
+            self._closing.pop(session_id, None)
+        self.evicted += 1
+
+    async def evict_idle(self):
+        cutoff = time() - self.idle_timeout
+        idle = [s.id for s in self._sessions.values() if s.last_used < cutoff]
+        for session_id in idle:
+            # a session may have been used while an earlier one was being saved
+            session = self._sessions.get(session_id)
+            if session is None or session.last_used >= cutoff or not self._evictable(session):
+                continue
+            print('Evicting idle session %s...' % session_id)
+            await self.evict(session_id)
+
+    # a session that fails to save keeps its turns in its journal, the others are still saved
+    async def close(self):
+        ids = list(self._sessions)
+        for session_id, res in zip(ids, await asyncio.gather(*[self.evict(session_id) for session_id in ids], return_exceptions=True)):
+            if isinstance(res, Exception):
+                print('ERROR: saving session %s failed, its turns are kept in the journal: %s' % (session_id, res))
+
+    def stats(self):
+        now = time()
+        return {
+            'sessions': len(self._sessions),
+            'evicted': self.evicted,
+            'idle_seconds': { s.id: now - s.last_used for s in self._sessions.values() }
+        }
+
+    async def _evict_over_limit(self):
+        while len(self._sessions) > self.max_sessions:
+            idle = [s for s in self._sessions.values() if self._evictable(s)]
+            if len(idle) == 0:
+                return
+            await self.evict(min(idle, key=lambda s: s.last_used).id)
+
+    def _evictable(self, session):
+        return session.id not in self._users and not session.lock.locked()
+
+    async def _close(self, session):
+        async with session.lock:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, in_context(session.andy.save_messages))
+            finally:
+                session.andy.close()
+
+def check_session_id(session_id):
+    if SESSION_ID.match(session_id) is None:
+        raise ValueError('session ids may only contain letters, digits, - and _')
+
+# the REPL commands, each returns the json body of its response
+async def run_command(manager, session, command):
+    if command == 'RESET':
+        await manager.run(session, Andy.reset)
+        return { 'command': command }
+    if command == 'LOAD':
+        return { 'command': command, 'context': await manager.run(session, Andy.load) }
+    if command == 'CLEAN':
+        await manager.run(session, Andy.clean_memories)
+        return { 'command': command }
+    if command == 'WRITE':
+        return { 'command': command, 'path': await manager.run(session, Andy.write_document) }
+    raise ValueError('unknown command ' + command)
+
+async def chat(manager, session, message, system=None, on_token=None):
+    async with manager.hold(session) as session:
+        return await session.andy.asend_chat(message, system, on_token)
+
+def create_app(manager, evict_every=60):
+    routes = web.RouteTableDef()
+
+    def session_id(request):
+        try:
+            check_session_id(request.match_info['session_id'])
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return request.match_info['session_id']
+
+    @routes.get('/sessions')
+    async def list_sessions(request):
+        return web.json_response(manager.stats())
+
+    @routes.post('/sessions/{session_id}/chat')
+    async def post_chat(request):
+        async with manager.use(session_id(request)) as session:
+            try:
+                body = await request.json()
+            except ValueError:
+                raise web.HTTPBadRequest(text='the body must be json')
+            if not isinstance(body, dict) or not isinstance(body.get('message'), str) or len(body['message'].strip()) == 0:
+                raise web.HTTPBadRequest(text='message is required')
+            if body.get('system') is not None and not isinstance(body['system'], str):
+                raise web.HTTPBadRequest(text='system must be a string')
+            try:
+                reply = await chat(manager, session, body['message'], body.get('system'))
+            except API_ERRORS as e:
+                raise web.HTTPBadGateway(text=str(e) or type(e).__name__)
+            return web.json_response({ 'reply': reply })
+
+    @routes.post('/sessions/{session_id}/{command:(reset|load|clean|write)}')
+    async def post_command(request):
+        async with manager.use(session_id(request)) as session:
+            try:
+                return web.json_response(await run_command(manager, session, request.match_info['command'].upper()))
+            except FileNotFoundError as e:
+                raise web.HTTPNotFound(text=str(e))
+            except API_ERRORS as e:
+                raise web.HTTPBadGateway(text=str(e) or type(e).__name__)
+
+    @routes.delete('/sessions/{session_id}')
+    async def delete_session(request):
+        await manager.evict(request.match_info['session_id'])
+        return web.json_response({ })
+
+    # text frames are chat messages or one of the REPL commands. replies stream back as
+    # { type: token } frames followed by { type: reply }, commands answer with { type: command }
+    @routes.get('/sessions/{session_id}/ws')
+    async def websocket(request):
+        sid = session_id(request)
+        await manager.get(sid)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for frame in ws:
+            if frame.type != WSMsgType.TEXT:
+                continue
+            # the session is looked up per message since it may have been evicted in between
+            async with manager.use(sid) as session:
+                text = frame.data.strip()
+                try:
+                    if text in COMMANDS:
+                        res = await run_command(manager, session, text)
+                        res['type'] = 'command'
+                        await ws.send_json(res)
+                        continue
+                    await ws.send_json({ 'type': 'reply', 'content': await _stream_chat(manager, ws, session, text) })
+                # the socket stays open, the next frame may succeed
+                except (FileNotFoundError,) + API_ERRORS as e:
+                    await ws.send_json({ 'type': 'error', 'message': str(e) or type(e).__name__ })
+        return ws
+
+    async def evict_loop(app):
+        while True:
+            await asyncio.sleep(evict_every)
+            await manager.evict_idle()
+
+    async def start(app):
+        app['evictor'] = asyncio.ensure_future(evict_loop(app))
+
+    async def stop(app):
+        app['evictor'].cancel()
+        try:
+            await manager.close()
+        finally:
+            # the api connection pool is shared by every session
+            await get_async_transport().close()
+
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    return app
+
+# tokens are queued by the chat callback and sent in order by a single writer
+async def _stream_chat(manager, ws, session, message):
+    queue = asyncio.Queue()
+    async def send_tokens():
+        while True:
+            token = await queue.get()
+            if token is None:
+                return
+            await ws.send_json({ 'type': 'token', 'content': token })
+    sender = asyncio.ensure_future(send_tokens())
+    try:
+        return await chat(manager, session, message, on_token=queue.put_nowait)
+    finally:
+        queue.put_nowait(None)
+        await sender
+
+def serve(api_key, org_key, host='127.0.0.1', port=8080, root='sessions', idle_timeout=900, max_sessions=64, **andy_options):
+    manager = SessionManager(api_key, org_key, root, idle_timeout, max_sessions, **andy_options)
+    web.run_app(create_app(manager), host=host, port=port)
@@ -0,0 +1,187 @@
+import json
+import os
+import re
+import numpy as np
+from tracing import span
+
+SEGMENT_FILE = re.compile(r'^(vectors(\.\d+)?\.f32|meta(\.\d+)?\.jsonl)$')
+
+# vectors live in an append-only float32 segment, one row per record, metadata lives in
+# an append-only jsonl log of records and tombstones keyed by a stable record id where
+# later records win. compaction rewrites both files without dead rows as a new generation,
+# ids stay the same and keep increasing with the row
+class EmbeddingStore:
+    def __init__(self, folder):
+        self.folder = folder
+        self._manifest_path = folder + '/manifest.json'
+        self.dim = None
+        self.rows = 0
+        self.generation = 0
+        # id of the first appended row minus its row, ids of compacted rows are in the log
+        self.id_offset = 0
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, 'r', encoding='utf-8') as infile:
+                manifest = json.load(infile)
+            self.dim = manifest['dim']
+            self.generation = manifest.get('generation', 0)
+            self.id_offset = manifest.get('id_offset', 0)
+        self._vectors_path, self._meta_path = self._paths(self.generation)
+        if self.dim is not None:
+            self._remove_stale()
+            row_bytes = self.dim * 4
+            size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+            if size % row_bytes != 0:
+                # drop a row that was only partially written before a crash
+                size -= size % row_bytes
+                with open(self._vectors_path, 'r+b') as outfile:
+                    outfile.truncate(size)
+            self.rows = size // row_bytes
+
+    def next_id(self):
+        return self.rows + self.id_offset
+
+    def vectors(self):
+        if self.rows == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self._vectors_path, dtype=np.float32, mode='r', shape=(self.rows, self.dim))
+
+    # replays the log in one sequential read, returns the id of every row and the live records by row
+    def read_log(self):
+        ids = np.arange(self.rows, dtype=np.int64) + self.id_offset
+        meta = { }
+        if not os.path.exists(self._meta_path):
+            return ids, meta
+        with open(self._meta_path, 'r', encoding='utf-8') as infile:
+            for line in infile:
+                if len(line.strip()) == 0:
+                    continue
+                rec = json.loads(line)
+                if 'row' in rec:
+                    row = rec.pop('row')
+                    if row < self.rows:
+                        ids[row] = rec['id']
+                elif rec.get('deleted'):
+                    row = int(np.searchsorted(ids, rec['id']))
+                else:
+                    row = rec['id'] - self.id_offset
+                if row < 0 or row >= self.rows or ids[row] != rec['id']:
+                    continue
+                if rec.get('deleted'):
+                    meta.pop(row, None)
+                else:
+                    meta[row] = rec
+        return ids, meta
+
+    def append(self, objs):
+        if len(objs) == 0:
+            return []
+        vectors = np.asarray([o['embedding'] for o in objs], dtype=np.float32)
+        if self.dim is None:
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+            self.dim = vectors.shape[1]
+            self._write_manifest()
+        with span('store.append', folder=self.folder, rows=len(objs), bytes_written=vectors.nbytes):
+            # vectors are written before metadata so a crash never leaves metadata without a row
+            with open(self._vectors_path, 'ab') as outfile:
+                outfile.write(vectors.tobytes())
+            ids = list(range(self.next_id(), self.next_id() + len(objs)))
+            self.rows += len(objs)
+            with open(self._meta_path, 'a', encoding='utf-8') as outfile:
+                for record_id, o in zip(ids, objs):
+                    rec = { 'id': record_id }
+                    rec.update({ k: v for k, v in o.items() if k != 'embedding' and k != 'id' })
+                    outfile.write(json.dumps(rec, separators=(',', ':')) + '\n')
+            return ids
+
+    def delete(self, ids):
+        if len(ids) == 0:
+            return
+        with open(self._meta_path, 'a', encoding='utf-8') as outfile:
+            for record_id in ids:
+                outfile.write(json.dumps({ 'id': int(record_id), 'deleted': True }, separators=(',', ':')) + '\n')
+
+    def compaction(self):
+        return Compaction(self)
+
+    def _paths(self, generation):
+        if generation == 0:
+            return self.folder + '/vectors.f32', self.folder + '/meta.jsonl'
+        return self.folder + '/vectors.%d.f32' % generation, self.folder + '/meta.%d.jsonl' % generation
+
+    def _write_manifest(self):
+        tmp = self._manifest_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as outfile:
+            json.dump({ 'dim': self.dim, 'dtype': 'float32', 'generation': self.generation, 'id_offset': self.id_offset }, outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp, self._manifest_path)
+
+    # files of other generations are left over from a compaction that crashed or could not delete them
+    def _remove_stale(self):
+        current = [os.path.basename(self._vectors_path), os.path.basename(self._meta_path)]
+        for f in os.listdir(self.folder):
+            if SEGMENT_FILE.match(f) and f not in current:
+                os.remove(self.folder + '/' + f)
+
+# writes the next generation of a store. rows are written in blocks, then commit() writes
+# the log and switches the manifest, which is the point the new generation takes over
+class Compaction:
+    def __init__(self, store):
+        self.store = store
+        self.generation = store.generation + 1
+        self.rows = 0
+        self._vectors_path, self._meta_path = store._paths(self.generation)
+        self._file = open(self._vectors_path, 'wb')
+
+    def write(self, vectors):
+        self._file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        self.rows += len(vectors)
+
+    # ids holds the id of every written row, meta the live records by new row
+    def commit(self, ids, meta):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        with open(self._meta_path, 'w', encoding='utf-8') as outfile:
+            for row, record_id in enumerate(ids):
+                rec = { 'id': int(record_id), 'row': row }
+                if row in meta:
+                    rec.update({ k: v for k, v in meta[row].items() if k != 'id' })
+                else:
+                    rec['deleted'] = True
+                outfile.write(json.dumps(rec, separators=(',', ':')) + '\n')
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+        store = self.store
+        old = [store._vectors_path, store._meta_path]
+        next_id = store.next_id()
+        store.generation = self.generation
+        store.rows = self.rows
+        store.id_offset = next_id - self.rows
+        store._vectors_path = self._vectors_path
+        store._meta_path = self._meta_path
+        store._write_manifest()
+        for path in old:
+            try:
+                os.remove(path)
+            except OSError:
+                # still mapped somewhere, it is removed the next time the store is opened
+                pass
+
+    def abort(self):
+        self._file.close()
+        for path in [self._vectors_path, self._meta_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+# files written by the jsonl/json layout that predates the store
+def legacy_files(folder):
+    if not os.path.exists(folder):
+        return []
+    return [
+        f for f in os.listdir(folder)
+        if (f.startswith('embedding_') and f.endswith('.jsonl'))
+            or (f.startswith('concept_') and f.endswith('.json'))
+    ]
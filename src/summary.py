@@ -1,13 +1,22 @@
 from gpt import GptCompletion, completion_config
-from util import open_file, stringify_conversation
+from util import open_prompt, stringify_conversation
 
 class Summary(GptCompletion):
     def __init__(self, api_key, org_key):
         super().__init__(api_key, org_key, 'text-davinci-003')
-        self._summary_prompt = open_file('prompts/prompt_executive_summary.txt')
-        self.prompt_tokens = self._encoding.encode(self._summary_prompt)
+        self.component = 'summary'
+        self._summary_prompt = open_prompt('prompts/prompt_executive_summary.txt')
+
+    @property
+    def _prompt_tokens(self):
+        return len(self._encoding.encode(self._summary_prompt))
 
     def summarize(self, conversation):
+        return self.complete(self._prompt(conversation), completion_config)
+
+    async def asummarize(self, conversation):
+        return await self.acomplete(self._prompt(conversation), completion_config)
+
+    def _prompt(self, conversation):
         conv_s = stringify_conversation(conversation)
-        prompt = self._summary_prompt.replace('<<INPUT>>', conv_s)
-        return self.complete(prompt, completion_config)
\ No newline at end of file
+        return self._summary_prompt.replace('<<INPUT>>', conv_s)
\ No newline at end of file
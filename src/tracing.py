@@ -0,0 +1,145 @@
+import contextvars
+import itertools
+import json
+import os
+import threading
+from time import time, perf_counter
+
+# upper bounds of the duration histogram buckets in seconds
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+_current = contextvars.ContextVar('andy_span', default=None)
+_ids = itertools.count(1)
+
+class Span:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.id = next(_ids)
+        parent = _current.get()
+        self.parent_id = None if parent is None else parent.id
+        self.trace_id = self.id if parent is None else parent.trace_id
+        self.start = None
+        self.duration = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time()
+        self._t0 = perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = perf_counter() - self._t0
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.tracer._finish(self)
+        return False
+
+class _NoopSpan:
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NOOP_SPAN = _NoopSpan()
+
+# nested timing spans exported as jsonl, one line per finished span, plus per-name
+# duration histograms in prometheus text format. while disabled span() returns a shared no-op
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._histograms = { }
+
+    def enable(self, path):
+        folder = os.path.dirname(path)
+        if folder != '' and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+        self.enabled = True
+
+    def span(self, name, **attributes):
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, attributes)
+
+    def prometheus(self):
+        lines = [
+            '# HELP andy_span_duration_seconds Duration of traced operations',
+            '# TYPE andy_span_duration_seconds histogram'
+        ]
+        with self._lock:
+            for name, h in sorted(self._histograms.items()):
+                for le, count in zip(BUCKETS, itertools.accumulate(h['buckets'])):
+                    lines.append('andy_span_duration_seconds_bucket{span="%s",le="%s"} %d' % (name, le, count))
+                lines.append('andy_span_duration_seconds_bucket{span="%s",le="+Inf"} %d' % (name, h['count']))
+                lines.append('andy_span_duration_seconds_sum{span="%s"} %f' % (name, h['sum']))
+                lines.append('andy_span_duration_seconds_count{span="%s"} %d' % (name, h['count']))
+        return '\n'.join(lines) + '\n'
+
+    def dump_prometheus(self, path):
+        with open(path, 'w', encoding='utf-8') as outfile:
+            outfile.write(self.prometheus())
+
+    # flushes the trace file and writes the histograms next to it
+    def close(self):
+        if not self.enabled:
+            return
+        self.dump_prometheus(os.path.splitext(self.path)[0] + '.prom')
+        with self._lock:
+            self._file.close()
+            self._file = None
+            self.enabled = False
+
+    def _finish(self, span):
+        rec = {
+            'trace_id': span.trace_id,
+            'span_id': span.id,
+            'parent_id': span.parent_id,
+            'name': span.name,
+            'start': span.start,
+            'duration': span.duration,
+            'attributes': span.attributes
+        }
+        with self._lock:
+            h = self._histograms.setdefault(span.name, { 'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0 })
+            for i, le in enumerate(BUCKETS):
+                if span.duration <= le:
+                    h['buckets'][i] += 1
+                    break
+            h['sum'] += span.duration
+            h['count'] += 1
+            if self._file is not None:
+                self._file.write(json.dumps(rec, default=str) + '\n')
+                self._file.flush()
+
+_tracer = Tracer()
+if os.environ.get('ANDY_TRACE') is not None:
+    _tracer.enable(os.environ['ANDY_TRACE'])
+
+def get_tracer():
+    return _tracer
+
+def enable_tracing(path='traces/trace.jsonl'):
+    _tracer.enable(path)
+    return _tracer
+
+def span(name, **attributes):
+    return _tracer.span(name, **attributes)
+
+# runs fn in a copy of the caller's context so spans opened on a worker thread nest under the caller's span
+def in_context(fn):
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
@@ -0,0 +1,365 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+from time import time, sleep
+
+# point this at a local stand-in server to run without the real api
+API_BASE = os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1')
+
+# records every request/response pair to a jsonl file, or serves a recorded session
+# back without touching the network. identical requests replay in recorded order
+class Cassette:
+    def __init__(self, path, mode='replay'):
+        if mode not in ['record', 'replay']:
+            raise ValueError('cassette mode must be record or replay')
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._responses = { }
+        if mode == 'replay':
+            with open(path, 'r', encoding='utf-8') as infile:
+                for line in infile:
+                    if len(line.strip()) == 0:
+                        continue
+                    rec = json.loads(line)
+                    self._responses.setdefault(self.key(rec['path'], rec['request']), []).append(rec['response'])
+        else:
+            folder = os.path.dirname(path)
+            if folder != '' and not os.path.exists(folder):
+                os.makedirs(folder)
+            open(path, 'w', encoding='utf-8').close()
+
+    def key(self, path, payload):
+        return hashlib.sha256(json.dumps([path, payload], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def replay(self, path, payload):
+        with self._lock:
+            responses = self._responses.get(self.key(path, payload))
+            if not responses:
+                raise LookupError('No recorded response in %s for POST %s' % (self.path, path))
+            # the last response for a request keeps replaying once earlier ones are used up
+            return responses.pop(0) if len(responses) > 1 else responses[0]
+
+    def record(self, path, payload, response):
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as outfile:
+                outfile.write(json.dumps({ 'path': path, 'request': payload, 'response': response }) + '\n')
+
+class RateLimiter:
+    def __init__(self, requests_per_second=None):
+        self.requests_per_second = requests_per_second
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            sleep(wait)
+
+    # claims the next request slot and returns how long to wait for it
+    def reserve(self):
+        if self.requests_per_second is None:
+            return 0
+        with self._lock:
+            now = time()
+            wait = self._next - now
+            self._next = max(now, self._next) + 1 / self.requests_per_second
+        return wait
+
+# one keep-alive connection pool shared by every api call in the process
+class Transport:
+    def __init__(
+        self,
+        base_url=API_BASE,
+        connect_timeout=5,
+        read_timeout=120,
+        max_retries=5,
+        backoff=0.5,
+        max_backoff=30,
+        requests_per_second=None,
+        pool_size=16,
+        cassette=None
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = RateLimiter(requests_per_second)
+        self.cassette = cassette
+        self.pool_size = pool_size
+        # opened on the first request so requests is not imported at startup
+        self.session = None
+        self._session_lock = threading.Lock()
+
+    # returns the decoded json body, from the cassette when one is replaying
+    def post(self, path, api_key, org, payload):
+        if self.cassette is not None and self.cassette.mode == 'replay':
+            return self.cassette.replay(path, payload)
+        _, body = self._post(path, api_key, org, payload)
+        if self.cassette is not None:
+            self.cassette.record(path, payload, body)
+        return body
+
+    # yields each decoded server-sent event of a streamed response. an error
+    # response is yielded as a single event so callers handle it like post()
+    def post_stream(self, path, api_key, org, payload):
+        if self.cassette is not None and self.cassette.mode == 'replay':
+            for event in self.cassette.replay(path, payload):
+                yield event
+            return
+        events = []
+        res, body = self._post(path, api_key, org, payload, stream=True)
+        if body is not None:
+            events.append(body)
+            yield body
+        else:
+            with res:
+                # event streams carry no charset, requests would otherwise decode them as latin-1
+                res.encoding = 'utf-8'
+                for line in res.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith('data:'):
+                        continue
+                    data = line[len('data:'):].strip()
+                    if data == '[DONE]':
+                        break
+                    event = json.loads(data)
+                    events.append(event)
+                    yield event
+        if self.cassette is not None:
+            self.cassette.record(path, payload, events)
+
+    def _client(self):
+        with self._session_lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+            return self.session
+
+    # retries 429s, 5xx, overloaded errors and connection failures. returns the response
+    # and its decoded body, or no body for a successful stream that is still to be read
+    def _post(self, path, api_key, org, payload, stream=False):
+        import requests
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                res = self._client().post(self.base_url + path,
+                    headers={
+                        'Authorization': 'Bearer ' + api_key,
+                        'OpenAI-Organization': org
+                    },
+                    json=payload,
+                    timeout=self.timeout,
+                    stream=stream
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                print('ERROR: %s. Retrying request...' % type(e).__name__)
+                self._wait(attempt)
+                attempt += 1
+                continue
+
+            if stream and res.status_code == 200:
+                return res, None
+            retry = res.status_code == 429 or res.status_code >= 500
+            try:
+                body = res.json()
+            except ValueError:
+                if not retry or attempt >= self.max_retries:
+                    res.raise_for_status()
+                    raise
+                body = { }
+            error = body.get('error') or { }
+            if 'overloaded' in (error.get('message') or ''):
+                retry = True
+            if not retry or attempt >= self.max_retries:
+                return res, body
+            print('ERROR: Server returned %d. Retrying request...' % res.status_code)
+            self._wait(attempt, res.headers.get('Retry-After'))
+            attempt += 1
+
+    def _wait(self, attempt, retry_after=None):
+        sleep(_retry_delay(attempt, self.backoff, self.max_backoff, retry_after))
+
+# asyncio counterpart of Transport on an aiohttp connection pool, with the same
+# retries, rate limit and cassette handling. at most max_in_flight requests run at once
+class AsyncTransport:
+    def __init__(
+        self,
+        base_url=API_BASE,
+        connect_timeout=5,
+        read_timeout=120,
+        max_retries=5,
+        backoff=0.5,
+        max_backoff=30,
+        requests_per_second=None,
+        max_in_flight=64,
+        cassette=None
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_in_flight = max_in_flight
+        self.limiter = RateLimiter(requests_per_second)
+        self.cassette = cassette
+        self._session = None
+        self._loop = None
+        self._semaphore = None
+
+    async def post(self, path, api_key, org, payload):
+        if self.cassette is not None and self.cassette.mode == 'replay':
+            return self.cassette.replay(path, payload)
+        async with self._slot():
+            res, body = await self._post(path, api_key, org, payload)
+            res.release()
+        if self.cassette is not None:
+            self.cassette.record(path, payload, body)
+        return body
+
+    async def post_stream(self, path, api_key, org, payload):
+        if self.cassette is not None and self.cassette.mode == 'replay':
+            for event in self.cassette.replay(path, payload):
+                yield event
+            return
+        events = []
+        async with self._slot():
+            res, body = await self._post(path, api_key, org, payload, stream=True)
+            if body is not None:
+                res.release()
+                events.append(body)
+                yield body
+            else:
+                async with res:
+                    async for raw in res.content:
+                        line = raw.decode('utf-8').strip()
+                        if not line.startswith('data:'):
+                            continue
+                        data = line[len('data:'):].strip()
+                        if data == '[DONE]':
+                            break
+                        event = json.loads(data)
+                        events.append(event)
+                        yield event
+        if self.cassette is not None:
+            self.cassette.record(path, payload, events)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _slot(self):
+        self._client()
+        return self._semaphore
+
+    # sessions belong to an event loop, so a new one is opened when the loop changes
+    def _client(self):
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            )
+        return self._session
+
+    async def _post(self, path, api_key, org, payload, stream=False):
+        import aiohttp
+        attempt = 0
+        while True:
+            wait = self.limiter.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                res = await self._client().post(self.base_url + path,
+                    headers={
+                        'Authorization': 'Bearer ' + api_key,
+                        'OpenAI-Organization': org
+                    },
+                    json=payload
+                )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                print('ERROR: %s. Retrying request...' % type(e).__name__)
+                await asyncio.sleep(_retry_delay(attempt, self.backoff, self.max_backoff))
+                attempt += 1
+                continue
+
+            if stream and res.status == 200:
+                return res, None
+            retry = res.status == 429 or res.status >= 500
+            try:
+                body = await res.json(content_type=None)
+            except ValueError:
+                if not retry or attempt >= self.max_retries:
+                    res.raise_for_status()
+                    raise
+                body = { }
+            error = body.get('error') or { }
+            if 'overloaded' in (error.get('message') or ''):
+                retry = True
+            if not retry or attempt >= self.max_retries:
+                return res, body
+            print('ERROR: Server returned %d. Retrying request...' % res.status)
+            res.release()
+            await asyncio.sleep(_retry_delay(attempt, self.backoff, self.max_backoff, res.headers.get('Retry-After')))
+            attempt += 1
+
+def _retry_delay(attempt, backoff, max_backoff, retry_after=None):
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    # exponential backoff with full jitter
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+_transport = None
+_async_transport = None
+_env_cassette = None
+
+# the cassette named by OPENAI_CASSETTE, shared by the sync and async transports
+def _cassette_from_env():
+    global _env_cassette
+    if _env_cassette is None and os.environ.get('OPENAI_CASSETTE') is not None:
+        _env_cassette = Cassette(os.environ['OPENAI_CASSETTE'], os.environ.get('OPENAI_CASSETTE_MODE', 'replay'))
+    return _env_cassette
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        _transport = Transport(cassette=_cassette_from_env())
+    return _transport
+
+def get_async_transport():
+    global _async_transport
+    if _async_transport is None:
+        _async_transport = AsyncTransport(cassette=_cassette_from_env())
+    return _async_transport
+
+# replaces the shared transport, e.g. to change base_url, timeouts or the rate limit
+def configure_transport(**kwargs):
+    global _transport
+    _transport = Transport(**kwargs)
+    return _transport
+
+def configure_async_transport(**kwargs):
+    global _async_transport
+    _async_transport = AsyncTransport(**kwargs)
+    return _async_transport
@@ -0,0 +1,67 @@
+import json
+import os
+import threading
+
+# aggregates requests, tokens and latency of api calls per component
+# (anticipation, salience, concepts, memory, summary, write, chat)
+class UsageLedger:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._components = { }
+
+    def record(self, component, prompt_tokens=0, completion_tokens=0, latency=0, cached=False):
+        with self._lock:
+            c = self._components.setdefault(component, {
+                'requests': 0,
+                'cached': 0,
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+                'total_tokens': 0,
+                'latency': 0
+            })
+            if cached:
+                c['cached'] += 1
+                return
+            c['requests'] += 1
+            c['prompt_tokens'] += prompt_tokens
+            c['completion_tokens'] += completion_tokens
+            c['total_tokens'] += prompt_tokens + completion_tokens
+            c['latency'] += latency
+
+    def component(self, name):
+        with self._lock:
+            return dict(self._components.get(name, { }))
+
+    def summary(self):
+        with self._lock:
+            return { name: dict(c) for name, c in self._components.items() }
+
+    def totals(self):
+        totals = { 'requests': 0, 'cached': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0, 'latency': 0 }
+        for c in self.summary().values():
+            for k in totals:
+                totals[k] += c[k]
+        return totals
+
+    def report(self):
+        lines = ['%-14s %8s %8s %12s %12s %10s' % ('component', 'requests', 'cached', 'prompt', 'completion', 'latency')]
+        for name, c in sorted(self.summary().items()):
+            lines.append('%-14s %8d %8d %12d %12d %9.2fs' % (
+                name, c['requests'], c['cached'], c['prompt_tokens'], c['completion_tokens'], c['latency']))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        folder = os.path.dirname(path)
+        if folder != '' and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(path, 'w', encoding='utf-8') as outfile:
+            json.dump({ 'components': self.summary(), 'totals': self.totals() }, outfile, indent=2)
+
+    def reset(self):
+        with self._lock:
+            self._components = { }
+
+_ledger = UsageLedger()
+
+def get_usage_ledger():
+    return _ledger
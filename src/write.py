@@ -1,66 +1,134 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import time
 from gpt import GptCompletion, EmbeddingFactory, completion_config
-from util import open_file, get_closest_embeddings
+from util import open_prompt, get_closest_embeddings, get_lexical_matches
+from index import get_index
+from tracing import span, in_context
+
+# the write prompt asks the model to finish the document with this line
+END_MARKER = 'END_DOCUMENT'
 
 class Write(GptCompletion):
-    def __init__(self, api_key, org_key):
+    def __init__(self, api_key, org_key, root=''):
         super().__init__(api_key, org_key, 'text-davinci-003')
+        self.component = 'write'
+        self._memory_folder = os.path.join(root, 'embeddings')
+        self._concept_folder = os.path.join(root, 'concepts')
+        self._document_folder = os.path.join(root, 'documents')
         self.embedFactory = EmbeddingFactory(api_key, org_key)
-    
-    def write_document(self, last_memory):
-        prompt = open_file('prompts/prompt_write_query.txt')\
+        self.embedFactory.component = 'write'
+
+    # writes the document chunk by chunk to path until it is target_tokens long, the model ends
+    # it or max_chunks were written, and returns the path. while a chunk is generated the memories
+    # for the one after it are already queried and retrieved from the text written before it,
+    # unless the chunk is expected to be the last. only the last context_tokens of the document
+    # are kept to continue from
+    def write_document(self, last_memory, path=None, target_tokens=4000, max_chunks=50, context_tokens=1500):
+        if path is None:
+            if not os.path.exists(self._document_folder):
+                os.makedirs(self._document_folder)
+            path = os.path.join(self._document_folder, 'document_%s.txt' % time())
+        # concepts are read once and every query is only retrieved once per document
+        concepts = self._format([c['data'] for c in get_index(self._concept_folder).items()])
+        retrieved = { }
+
+        prompt = open_prompt('prompts/prompt_write_query.txt')\
             .replace('<<MEMORY>>', last_memory)
-        
-        queries = self.complete(prompt, completion_config)
-        queries = queries.split('\n')
-        def get_memories(q_list):
-            memories = [ ]
-            for q in q_list:
-                emb = self.embedFactory.get_embedding(q)
-                best_match = get_closest_embeddings('embeddings', emb, 1)
-                new_mem = best_match[0][1]['salient_points']
-                if new_mem in memories:
-                    continue
-                memories.append(new_mem)
-            
-            s_memories = ''
-            for m in memories:
-                s_memories += '- ' + m + '\n'
-            return s_memories
+        memories = self._recall(self.complete(prompt, completion_config).split('\n'), [], retrieved)
 
-        s_memories = get_memories(queries)
-        concept_files = os.listdir('concepts')
-        concepts = [ ]
-        for f in concept_files:
-            f_data = open_file('concepts/' + f)
-            if len(f_data) == 0:
-                continue
-            for line in f_data.split('\n'):
-                if len(line) == 0:
-                    continue
-                obj = json.loads(line)
-                concepts.append(obj['data'])
+        pool = ThreadPoolExecutor(max_workers=1)
+        try:
+            self._write_chunks(pool, path, memories, concepts, retrieved, target_tokens, max_chunks, context_tokens)
+        finally:
+            # a prefetch that already started for a chunk that will not be written is left to finish
+            pool.shutdown(wait=False, cancel_futures=True)
+        print('')
+        return path
 
-        s_concepts = ''
-        for c in concepts:
-            s_concepts += '- ' + c + '\n'
+    def _write_chunks(self, pool, path, memories, concepts, retrieved, target_tokens, max_chunks, context_tokens):
+        tail = ''
+        tail_tokens = []
+        written = 0
+        chunk_tokens = []
+        # the text the current memories were queried from
+        memories_tail = ''
+        with open(path, 'w', encoding='utf-8') as outfile:
+            for n in range(max_chunks):
+                prefetch = None
+                last = n + 1 == max_chunks or written + len(chunk_tokens) >= target_tokens
+                if tail != memories_tail and not last:
+                    prefetch = pool.submit(in_context(self._next_memories), memories, tail, retrieved)
+                    prefetch_tail = tail
+                with span('write.chunk', chunk=n) as s:
+                    chunk = self._write_chunk(memories, concepts, tail)
+                    s.set('chars', len(chunk))
+                done = END_MARKER in chunk or len(chunk.strip()) == 0
+                chunk = chunk.split(END_MARKER)[0]
+                if n == 0:
+                    chunk = chunk.lstrip()
+                outfile.write(chunk)
+                outfile.flush()
+                print(chunk, end='', flush=True)
 
-        prompt = open_file('prompts/prompt_write.txt')\
-            .replace('<<MEMORIES>>', s_memories)\
-            .replace('<<CONCEPTS>>', s_concepts)
+                chunk_tokens = self._encoding.encode(chunk)
+                written += len(chunk_tokens)
+                tail_tokens = (tail_tokens + chunk_tokens)[-context_tokens:]
+                tail = self._encoding.decode(tail_tokens)
+                if done or written >= target_tokens or n + 1 == max_chunks:
+                    if prefetch is not None:
+                        prefetch.cancel()
+                    break
+                if prefetch is not None:
+                    memories = prefetch.result()
+                    memories_tail = prefetch_tail
+                elif n == 0:
+                    # the first chunk has nothing to prefetch from. the second chunk then
+                    # prefetches nothing either, since its memories already follow this text
+                    memories = self._next_memories(memories, tail, retrieved)
+                    memories_tail = tail
 
-        document_beginning = self.complete(prompt, completion_config)
-        print(document_beginning)
+    def _write_chunk(self, memories, concepts, tail):
+        prompt = open_prompt('prompts/prompt_write.txt')\
+            .replace('<<MEMORIES>>', self._format(memories))\
+            .replace('<<CONCEPTS>>', concepts)
+        if tail != '':
+            prompt += '\n' + tail
+        return self.complete(prompt, completion_config)
+
+    # queries for memories that are not in the current list, based on what was written so far
+    def _next_memories(self, memories, tail, retrieved):
+        prompt = open_prompt('prompts/prompt_write_memory.txt')\
+            .replace('<<MEMORIES>>', self._format(memories))\
+            .replace('<<DOCUMENT>>', tail)
+        queries = self.complete(prompt, completion_config).split('\n')
+        new_memories = self._recall(queries, memories, retrieved)
+        # nothing new came back, keep writing from the same memories
+        return new_memories if len(new_memories) > 0 else memories
+
+    # the best matching memory of each query, skipping ones already in memories
+    def _recall(self, queries, memories, retrieved):
+        queries = [q.strip() for q in queries if len(q.strip()) > 0]
+        missing = list(dict.fromkeys(q for q in queries if q not in retrieved))
+        with span('write.recall', queries=len(queries), missing=len(missing)):
+            for q in missing:
+                best_match = get_lexical_matches(self._memory_folder, q, 1)
+                if len(best_match) > 0:
+                    retrieved[q] = best_match[0][1]['salient_points']
+            missing = [q for q in missing if q not in retrieved]
+            for q, emb in zip(missing, self.embedFactory.get_embeddings(missing)):
+                best_match = get_closest_embeddings(self._memory_folder, emb, 1, text=q)
+                retrieved[q] = best_match[0][1]['salient_points'] if len(best_match) > 0 else None
+        found = []
+        for q in queries:
+            mem = retrieved[q]
+            if mem is None or mem in memories or mem in found:
+                continue
+            found.append(mem)
+        return found
 
-        prompt = open_file('prompts/prompt_write_memory.txt')\
-            .replace('<<MEMORIES>>', s_memories)\
-            .replace('<<DOCUMENT>>', document_beginning)
-        
-        new_memory_queries = self.complete(prompt, completion_config)
-        new_memories = get_memories(new_memory_queries.split('\n'))
-        prompt = open_file('prompts/prompt_write.txt')\
-            .replace('<<MEMORIES>>', new_memories)\
-            .replace('<<CONCEPTS>>', s_concepts)\
-            + '\n' + document_beginning
-        
-        document_chunk = self.complete(prompt, completion_config)
-        return document_chunk
+    def _format(self, items):
+        s = ''
+        for i in items:
+            s += '- ' + i + '\n'
+        return s
@@ -0,0 +1,16 @@
+import os
+import shutil
+import sys
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+# runs a test in an empty working directory holding a copy of prompts/, like main.py expects
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    shutil.copytree(os.path.join(ROOT, 'prompts'), str(tmp_path / 'prompts'))
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    from index import clear_indexes
+    clear_indexes()
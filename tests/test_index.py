@@ -0,0 +1,22 @@
+import numpy as np
+from index import VectorIndex
+
+# a store that is already deduplicated, then a batch with copies of stored rows, copies within
+# the batch and new rows. checking only the batch must drop the same ids as checking everything
+def test_incremental_dedupe_matches_full_pass(tmp_path):
+    rng = np.random.default_rng(0)
+    dim = 32
+    index = VectorIndex(str(tmp_path / 'store'))
+    stored = rng.standard_normal((50, dim)).astype(np.float32)
+    index.add([{ 'embedding': v } for v in stored])
+    assert index.duplicates(0.9) == []
+
+    fresh = rng.standard_normal((3, dim)).astype(np.float32)
+    batch = [stored[3], stored[17], fresh[0], fresh[0], stored[17], fresh[1], stored[40], fresh[2], fresh[2]]
+    batch = [v + rng.standard_normal(dim).astype(np.float32) * 0.01 for v in batch]
+    new_ids = index.add([{ 'embedding': v } for v in batch])
+
+    full = index.duplicates(0.9)
+    assert sorted(index.duplicates(0.9, new_ids)) == sorted(full)
+    # the newest copy of each group survives
+    assert sorted(full) == sorted([3, 17, 40, new_ids[1], new_ids[2], new_ids[7]])
@@ -0,0 +1,62 @@
+import errno
+import os
+import shutil
+import numpy as np
+import pytest
+import journal
+from andy import Andy
+from index import VectorIndex
+from journal import Journal
+
+def _turn(rng, n):
+    return {
+        'memory': { 'time': str(n), 'salient_points': 'turn %d' % n, 'tokens': 3, 'embedding': rng.standard_normal(16).tolist() },
+        'concepts': { 'add': [{ 'data': 'concept %d' % n, 'tokens': 2, 'embedding': rng.standard_normal(16).tolist() }], 'update': [] }
+    }
+
+def _live(workdir, folder):
+    return len(VectorIndex(str(workdir / folder)))
+
+# turns journaled by a run that stopped before storing them are stored by the next start, and a
+# crash between storing them and discarding the journal does not store them a second time
+def test_replayed_turns_are_stored_once(workdir):
+    rng = np.random.default_rng(0)
+    j = Journal(str(workdir / 'journal'))
+    for n in range(3):
+        j.append(_turn(rng, n))
+    j.close()
+    segments = os.listdir(str(workdir / 'journal'))
+    shutil.copytree(str(workdir / 'journal'), str(workdir / 'journal_copy'))
+
+    andy = Andy('key', 'org', root=str(workdir))
+    andy.close()
+    assert _live(workdir, 'embeddings') == 3
+    assert _live(workdir, 'concepts') == 3
+    assert os.listdir(str(workdir / 'journal')) == []
+
+    # the segments come back as if the process died before discarding them
+    for f in segments:
+        shutil.copy(str(workdir / 'journal_copy' / f), str(workdir / 'journal' / f))
+    andy = Andy('key', 'org', root=str(workdir))
+    andy.close()
+    assert _live(workdir, 'embeddings') == 3
+    assert _live(workdir, 'concepts') == 3
+
+    andy = Andy('key', 'org', root=str(workdir))
+    assert andy.memory_data == []
+    andy.close()
+
+# a failed write is raised by every later call instead of leaving callers waiting on the writer
+def test_failed_write_is_raised(tmp_path, monkeypatch):
+    j = Journal(str(tmp_path))
+    def fsync(fd):
+        raise OSError(errno.ENOSPC, 'No space left on device')
+    monkeypatch.setattr(journal.os, 'fsync', fsync)
+    j.append({ 'n': 1 })
+    with pytest.raises(OSError):
+        j.rotate()
+    with pytest.raises(OSError):
+        j.append({ 'n': 2 })
+    with pytest.raises(OSError):
+        j.close()
+    assert not j._thread.is_alive()
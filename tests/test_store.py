@@ -0,0 +1,55 @@
+import numpy as np
+from index import VectorIndex
+from store import EmbeddingStore
+
+def _objs(rng, n, dim=16):
+    return [{ 'n': i, 'embedding': v } for i, v in enumerate(rng.standard_normal((n, dim)).astype(np.float32))]
+
+def test_compaction_keeps_ids_generation_and_offset(tmp_path):
+    folder = str(tmp_path / 'store')
+    rng = np.random.default_rng(0)
+    index = VectorIndex(folder)
+    ids = index.add(_objs(rng, 20))
+    index.remove(ids[:10])
+    index.compact()
+    new_ids = index.add(_objs(rng, 5))
+    assert new_ids == list(range(20, 25))
+    index.close()
+
+    store = EmbeddingStore(folder)
+    assert store.generation == 1
+    assert store.next_id() == 25
+    reloaded = VectorIndex(folder)
+    assert sorted(m['id'] for m in reloaded.items()) == ids[10:] + new_ids
+    for record_id in ids[10:] + new_ids:
+        assert np.array_equal(reloaded.vector(record_id), index.vector(record_id))
+
+# rows added and removed while the live rows are copied are reconciled when the compaction commits
+def test_compaction_reconciles_concurrent_changes(tmp_path, monkeypatch):
+    folder = str(tmp_path / 'store')
+    rng = np.random.default_rng(1)
+    index = VectorIndex(folder)
+    ids = index.add(_objs(rng, 20))
+    index.remove(ids[:8])
+    added = []
+    compaction = index.store.compaction
+    def racing_compaction():
+        c = compaction()
+        write = c.write
+        def write_once(vectors):
+            c.write = write
+            added.extend(index.add(_objs(rng, 3)))
+            index.remove([ids[10], added[0]])
+            write(vectors)
+        c.write = write_once
+        return c
+    monkeypatch.setattr(index.store, 'compaction', racing_compaction)
+    index.compact()
+    expected = [i for i in ids[8:] + added if i not in [ids[10], added[0]]]
+    assert sorted(m['id'] for m in index.items()) == expected
+    index.close()
+
+    reloaded = VectorIndex(folder)
+    assert sorted(m['id'] for m in reloaded.items()) == expected
+    for record_id in expected:
+        assert np.array_equal(reloaded.vector(record_id), index.vector(record_id))